@@ -0,0 +1,207 @@
+"""
+Генератор синтетического каталога фильмов для бенчмарков.
+
+Формирует таблицы content.* с заданным количеством фильмов, персонажей
+и жанров. Популярность персонажей подчиняется закону Ципфа с показателем
+skew: при skew=0 персонажи распределены равномерно, при skew>1 немногие
+персонажи участвуют в большой доле фильмов (тяжелый разворот изменений).
+Генерация детерминирована параметром seed.
+
+Каталог можно сохранить как фикстуру строк выборки (NDJSON в формате
+запроса filmwork_by_id) или загрузить в локальный PostgreSQL.
+Фикстуру можно также записать с реального PostgreSQL.
+
+Запуск из каталога postgres_to_es:
+    python -m benchmarks.catalogue --films 10000 --fixture rows.ndjson
+    python -m benchmarks.catalogue --films 10000 --seed-postgres
+    python -m benchmarks.catalogue --record --fixture rows.ndjson
+"""
+import argparse
+import gzip
+import json
+import random
+import uuid
+from datetime import datetime, timezone
+from itertools import accumulate
+from typing import Iterable, Iterator
+
+from psycopg2.extras import execute_values
+from services.pg import PostgresService, queries
+
+ROLES = ('actor', 'writer', 'director')
+TABLES = ('genre', 'person', 'film_work', 'genre_film_work',
+          'person_film_work')
+
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_catalogue(films: int, persons: int, genres: int,
+                       skew: float = 1.0, cast: tuple = (3, 12),
+                       genres_per_film: tuple = (1, 3),
+                       seed: int = 0) -> dict[str, list[dict]]:
+    """
+    Возвращает строки таблиц каталога. Количество персонажей фильма
+    и жанров фильма выбирается равномерно из диапазонов cast
+    и genres_per_film, сами персонажи выбираются с весами Ципфа
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    catalogue: dict[str, list[dict]] = {table: [] for table in TABLES}
+
+    catalogue['genre'] = [
+        {'id': make_uuid(rng), 'name': f'genre-{i}', 'description': None,
+         'created': now, 'modified': now} for i in range(genres)]
+    catalogue['person'] = [
+        {'id': make_uuid(rng), 'full_name': f'person-{i}',
+         'created': now, 'modified': now} for i in range(persons)]
+    weights = list(accumulate(
+        1 / (rank + 1) ** skew for rank in range(persons)))
+
+    for film in range(films):
+        film_id = make_uuid(rng)
+        catalogue['film_work'].append({
+            'id': film_id, 'title': f'title-{film}',
+            'description': f'description-{film}',
+            'rating': round(rng.uniform(1, 10), 1), 'type': 'movie',
+            'created': now, 'modified': now})
+        for genre in rng.sample(catalogue['genre'],
+                                min(rng.randint(*genres_per_film), genres)):
+            catalogue['genre_film_work'].append({
+                'id': make_uuid(rng), 'film_work_id': film_id,
+                'genre_id': genre['id'], 'created': now})
+        cast_size = min(rng.randint(*cast), persons)
+        chosen: dict[str, None] = {}
+        while len(chosen) < cast_size:
+            person = rng.choices(catalogue['person'],
+                                 cum_weights=weights)[0]
+            chosen[person['id']] = None
+        for person_id in chosen:
+            catalogue['person_film_work'].append({
+                'id': make_uuid(rng), 'film_work_id': film_id,
+                'person_id': person_id, 'role': rng.choice(ROLES),
+                'created': now})
+    return catalogue
+
+
+def catalogue_rows(catalogue: dict[str, list[dict]]) -> Iterator[dict]:
+    """
+    Строки выборки filmwork_rows для каталога: декартово произведение
+    film_work × person × genre, отсортированное по ID фильма
+    """
+    persons = {row['id']: row for row in catalogue['person']}
+    genres = {row['id']: row for row in catalogue['genre']}
+    film_persons: dict[str, list] = {}
+    film_genres: dict[str, list] = {}
+    for link in catalogue['person_film_work']:
+        film_persons.setdefault(link['film_work_id'], []).append(link)
+    for link in catalogue['genre_film_work']:
+        film_genres.setdefault(link['film_work_id'], []).append(
+            genres[link['genre_id']]['name'])
+
+    for film in sorted(catalogue['film_work'], key=lambda row: row['id']):
+        for link in film_persons.get(film['id']) or [None]:
+            for genre in film_genres.get(film['id']) or [None]:
+                person = persons[link['person_id']] if link else {}
+                yield {
+                    'fw_id': film['id'], 'title': film['title'],
+                    'description': film['description'],
+                    'rating': film['rating'], 'type': film['type'],
+                    'created': film['created'],
+                    'modified': film['modified'],
+                    'role': link['role'] if link else None,
+                    'person_id': person.get('id'),
+                    'full_name': person.get('full_name'),
+                    'genre': genre,
+                }
+
+
+def open_fixture(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, f'{mode}t', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def write_fixture(rows: Iterable[dict], path: str) -> int:
+    """Сохраняет строки выборки в NDJSON (.gz сжимается)"""
+    count = 0
+    with open_fixture(path, 'w') as fixture:
+        for row in rows:
+            fixture.write(json.dumps(dict(row), default=str,
+                                     ensure_ascii=False))
+            fixture.write('\n')
+            count += 1
+    return count
+
+
+def read_fixture(path: str) -> Iterator[dict]:
+    """Построчно читает записанные строки выборки"""
+    with open_fixture(path, 'r') as fixture:
+        for line in fixture:
+            yield json.loads(line)
+
+
+def seed_postgres(conn, catalogue: dict[str, list[dict]],
+                  page_size: int = 1000) -> None:
+    """
+    Добавляет каталог в схему content локального PostgreSQL.
+    Существующие записи не удаляются: ID каталога случайные
+    """
+    with conn:
+        with conn.cursor() as curs:
+            for table in TABLES:
+                rows = catalogue[table]
+                if not rows:
+                    continue
+                columns = list(rows[0])
+                execute_values(
+                    curs,
+                    f'INSERT INTO content.{table} ({", ".join(columns)}) '
+                    f'VALUES %s',
+                    [tuple(row[column] for column in columns)
+                     for row in rows],
+                    page_size=page_size)
+                print(f'content.{table}: {len(rows)} rows')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--persons', type=int, default=5000)
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixture', help='файл фикстуры строк выборки')
+    parser.add_argument('--seed-postgres', action='store_true',
+                        help='загрузить каталог в PostgreSQL из .env')
+    parser.add_argument('--record', action='store_true',
+                        help='записать фикстуру с PostgreSQL из .env')
+    args = parser.parse_args()
+
+    if args.record:
+        pg = PostgresService()
+        try:
+            count = write_fixture(pg.stream(query=queries.all_filmworks()),
+                                  args.fixture)
+        finally:
+            pg.close()
+        print(f'{count} rows recorded to {args.fixture}')
+        return
+
+    catalogue = generate_catalogue(films=args.films, persons=args.persons,
+                                   genres=args.genres, skew=args.skew,
+                                   seed=args.seed)
+    if args.fixture:
+        count = write_fixture(catalogue_rows(catalogue), args.fixture)
+        print(f'{count} rows written to {args.fixture}')
+    if args.seed_postgres:
+        pg = PostgresService()
+        try:
+            seed_postgres(pg.conn, catalogue)
+        finally:
+            pg.close()
+
+
+if __name__ == '__main__':
+    main()
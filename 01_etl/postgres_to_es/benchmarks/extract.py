@@ -0,0 +1,93 @@
+"""
+Бенчмарк режимов извлечения фильмов из PostgreSQL.
+
+Сравнивает режим rows (декартово произведение film_work × person × genre,
+сборка документов в Python) с режимом aggregate (один документ на фильм,
+собранный на стороне PostgreSQL) на одних и тех же ID фильмов.
+
+Режим rows измеряется без кеша справочников (запрос с соединениями,
+сравним с прежними замерами) и с кешем (rows+cache: узкие связи фильмов
+и имена из кеша). Кеш очищается перед замером и прогревается первым
+повтором, выводится лучшее время. Выбор задает --cache, независимо
+от DIMENSION_CACHE_ENABLED.
+
+Запуск из каталога postgres_to_es (нужен доступ к PostgreSQL из .env):
+    python -m benchmarks.extract --films 100 1000
+    python -m benchmarks.extract --films 1000 --cache off
+"""
+import argparse
+import json
+from time import perf_counter
+
+from services.etl.transform import transform_filmworks
+from services.pg import PostgresService, queries
+from services.pg.service import genre_cache, person_cache
+
+CACHE_MODES = {'off': ('rows',), 'on': ('rows+cache',),
+               'both': ('rows', 'rows+cache')}
+
+
+def payload_size(rows: list) -> int:
+    """Примерный объем переданных данных в байтах"""
+    return sum(len(json.dumps(list(row), default=str)) for row in rows)
+
+
+def run_mode(pg: PostgresService, mode: str, ids: tuple,
+             repeat: int) -> dict:
+    """Возвращает лучшие времена извлечения и сборки документов для режима"""
+    extract_time = transform_time = float('inf')
+    person_cache.clear()
+    genre_cache.clear()
+    for _ in range(repeat):
+        started = perf_counter()
+        if mode == 'aggregate':
+            rows = pg.get_filmwork_documents(ids=ids)
+        elif mode == 'rows+cache':
+            rows = pg.get_filmwork_rows(ids=ids)
+        else:
+            rows = pg.executor(query=queries.filmwork_by_id(ids=ids))
+        extracted = perf_counter()
+        if mode == 'aggregate':
+            documents = list(rows)
+        else:
+            documents = list(transform_filmworks(rows=rows))
+        transformed = perf_counter()
+        extract_time = min(extract_time, extracted - started)
+        transform_time = min(transform_time, transformed - extracted)
+    return {
+        'rows': len(rows),
+        'bytes': payload_size(rows),
+        'documents': len(documents),
+        'extract': extract_time,
+        'transform': transform_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--films', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cache', default='both', choices=tuple(CACHE_MODES),
+                        help='режим rows без кеша справочников, с кешем '
+                             'или оба')
+    args = parser.parse_args()
+
+    pg = PostgresService()
+    try:
+        print(f'{"films":>7} {"mode":>10} {"rows":>8} {"bytes":>11} '
+              f'{"extract, s":>11} {"transform, s":>13}')
+        for films in args.films:
+            ids = tuple(row['id'] for row in pg.executor(
+                f'SELECT id FROM content.film_work ORDER BY id '
+                f'LIMIT {films};'))
+            for mode in (*CACHE_MODES[args.cache], 'aggregate'):
+                result = run_mode(pg, mode, ids, args.repeat)
+                print(f'{len(ids):>7} {mode:>10} {result["rows"]:>8} '
+                      f'{result["bytes"]:>11} {result["extract"]:>11.4f} '
+                      f'{result["transform"]:>13.4f}')
+    finally:
+        pg.close()
+
+
+if __name__ == '__main__':
+    main()
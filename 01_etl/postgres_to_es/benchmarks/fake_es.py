@@ -0,0 +1,224 @@
+"""
+Локальная замена Elasticsearch для бенчмарков загрузки.
+
+HTTP-сервер отвечает на запросы, которые делает ElasticsearchService
+(ping, псевдонимы, создание и настройка индексов), и принимает пакеты
+_bulk в формате NDJSON. Документы не хранятся: сервер только разбирает
+пакет, отвечает по каждому действию и ведет статистику. Задержка ответа
+(latency на запрос и per_document на документ) и доля отклоненных
+с кодом 429 документов (reject_rate) задаются параметрами.
+
+Запуск отдельным процессом из каталога postgres_to_es:
+    python -m benchmarks.fake_es --port 9201 --latency 0.005
+"""
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+from typing import Optional
+
+ES_VERSION = {'number': '7.17.0', 'build_flavor': 'default'}
+
+
+class BulkStats:
+    """Статистика принятых пакетов _bulk"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.documents = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.latencies: list[float] = []
+
+    def add(self, documents: int, rejected: int, size: int,
+            latency: float) -> None:
+        with self.lock:
+            self.requests += 1
+            self.documents += documents
+            self.rejected += rejected
+            self.bytes += size
+            self.latencies.append(latency)
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'FakeElasticsearch'
+
+    def log_message(self, format, *args):
+        """Журнал запросов не нужен и искажает замеры"""
+
+    def respond(self, status: int = 200, body: Optional[dict] = None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    @property
+    def parts(self) -> list[str]:
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def do_HEAD(self):
+        parts = self.parts
+        if not parts:
+            return self.respond()
+        if parts[0] == '_alias':
+            return self.respond(200 if parts[1] in self.server.aliases
+                                else 404)
+        self.respond(200 if parts[0] in self.server.indexes else 404)
+
+    def do_GET(self):
+        parts = self.parts
+        if not parts:
+            return self.respond(body={'name': 'fake', 'version': ES_VERSION,
+                                      'tagline': 'You Know, for Search'})
+        if parts[0] == '_alias':
+            if len(parts) > 1:
+                indexes = self.server.aliases.get(parts[1])
+                if not indexes:
+                    return self.respond(404, {'status': 404})
+                return self.respond(body={index: {'aliases': {parts[1]: {}}}
+                                          for index in indexes})
+            return self.respond(body={
+                index: {'aliases': {alias: {} for alias, indexes
+                                    in self.server.aliases.items()
+                                    if index in indexes}}
+                for index in self.server.indexes})
+        self.respond(body={'acknowledged': True})
+
+    def do_PUT(self):
+        self.read_body()
+        parts = self.parts
+        if len(parts) == 1:
+            self.server.indexes.add(parts[0])
+            return self.respond(body={'acknowledged': True,
+                                      'index': parts[0]})
+        self.respond(body={'acknowledged': True})
+
+    def do_DELETE(self):
+        parts = self.parts
+        if parts:
+            self.server.indexes.discard(parts[0])
+        self.respond(body={'acknowledged': True})
+
+    def do_POST(self):
+        body = self.read_body()
+        parts = self.parts
+        if parts and parts[-1] == '_bulk':
+            return self.bulk(body=body,
+                             index=parts[0] if len(parts) > 1 else None)
+        if parts and parts[-1] == '_aliases':
+            self.update_aliases(json.loads(body))
+        self.respond(body={'acknowledged': True, 'updated': 0})
+
+    def bulk(self, body: bytes, index: Optional[str]):
+        """Разбирает пакет NDJSON и отвечает по каждому действию"""
+        started = perf_counter()
+        lines = body.splitlines()
+        items, rejected = [], 0
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            operation, meta = next(iter(action.items()))
+            position += 1 if operation == 'delete' else 2
+            result = {'_index': meta.get('_index', index),
+                      '_id': meta.get('_id'), 'status': 200,
+                      'result': 'updated'}
+            if random.random() < self.server.reject_rate:
+                rejected += 1
+                result.update(status=429, error={
+                    'type': 'es_rejected_execution_exception',
+                    'reason': 'rejected by fake Elasticsearch'})
+            items.append({operation: result})
+
+        sleep(self.server.latency + self.server.per_document * len(items))
+        self.server.stats.add(documents=len(items), rejected=rejected,
+                              size=len(body),
+                              latency=perf_counter() - started)
+        self.respond(body={'took': 1, 'errors': bool(rejected),
+                           'items': items})
+
+    def update_aliases(self, body: dict) -> None:
+        aliases = self.server.aliases
+        for action in body.get('actions', []):
+            operation, params = next(iter(action.items()))
+            if operation == 'add':
+                aliases.setdefault(params['alias'], set()).add(
+                    params['index'])
+            elif operation == 'remove':
+                aliases.get(params['alias'], set()).discard(params['index'])
+            elif operation == 'remove_index':
+                self.server.indexes.discard(params['index'])
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """
+    Сервер, совместимый с клиентом elasticsearch-py в объеме запросов
+    ETL. Используется как контекстный менеджер: сервер работает
+    в фоновом потоке, пока открыт контекст
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, per_document: float = 0.0,
+                 reject_rate: float = 0.0):
+        super().__init__((host, port), FakeElasticsearchHandler)
+        self.latency = latency
+        self.per_document = per_document
+        self.reject_rate = reject_rate
+        self.indexes: set[str] = set()
+        self.aliases: dict[str, set[str]] = {}
+        self.stats = BulkStats()
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--per-document', type=float, default=0.0)
+    parser.add_argument('--reject-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeElasticsearch(host=args.host, port=args.port,
+                               latency=args.latency,
+                               per_document=args.per_document,
+                               reject_rate=args.reject_rate)
+    print(f'Fake Elasticsearch on {server.host}:{server.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        stats = server.stats
+        print(f'{stats.requests} bulk requests, {stats.documents} '
+              f'documents, {stats.rejected} rejected, {stats.bytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Сквозной бенчмарк extract/transform/load.
+
+Источник строк: синтетический каталог (synthetic), записанная фикстура
+(fixture) или локальный PostgreSQL (postgres). Загрузка идет через
+ElasticsearchService в локальную замену Elasticsearch (по умолчанию)
+или в Elasticsearch из .env (--real-es).
+
+Фильмы обрабатываются пакетами по --batch. По каждой стадии выводится
+суммарное время, пропускная способность и задержка пакета (p50, p95,
+максимум), поэтому прогоны до и после изменения можно сравнивать.
+
+Запуск из каталога postgres_to_es:
+    python -m benchmarks.pipeline --source synthetic --films 5000
+    python -m benchmarks.pipeline --source fixture --fixture rows.ndjson
+    python -m benchmarks.pipeline --source postgres --mode aggregate
+"""
+import argparse
+import statistics
+from itertools import groupby, islice
+from time import perf_counter
+from typing import Iterator
+
+from benchmarks.catalogue import (catalogue_rows, generate_catalogue,
+                                  read_fixture)
+from benchmarks.fake_es import FakeElasticsearch
+from config.settings import es_settings
+from services.es import ElasticsearchService
+from services.etl.transform import transform_filmworks
+from services.pg import PostgresService, models
+
+STAGES = ('extract', 'transform', 'load')
+
+
+def row_batches(rows: Iterator[dict], batch: int) -> Iterator[list]:
+    """Строки выборки пакетами по batch фильмов"""
+    films = groupby(rows, key=lambda row: row['fw_id'])
+    while page := [list(film_rows) for _, film_rows in islice(films, batch)]:
+        yield [row for film_rows in page for row in film_rows]
+
+
+def postgres_batches(pg: PostgresService, batch: int,
+                     mode: str) -> Iterator[tuple]:
+    """Пакеты строк или готовых документов фильмов из PostgreSQL"""
+    ids = [row['id'] for row in pg.executor(
+        'SELECT id FROM content.film_work ORDER BY id;')]
+    for start in range(0, len(ids), batch):
+        page = tuple(ids[start:start + batch])
+        if mode == 'aggregate':
+            yield pg.get_filmwork_documents(ids=page)
+        else:
+            yield pg.get_filmwork_instances(ids=page)
+
+
+def transform(data: list, mode: str) -> list[dict]:
+    documents = data if mode == 'aggregate' else transform_filmworks(data)
+    return list(models.validate_filmworks(documents))
+
+
+def run(batches: Iterator, es: ElasticsearchService, mode: str) -> dict:
+    """Прогоняет пакеты через стадии и собирает задержки по стадиям"""
+    timings: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    documents = 0
+    while True:
+        started = perf_counter()
+        data = next(batches, None)
+        extracted = perf_counter()
+        if data is None:
+            break
+        batch_documents = transform(data=data, mode=mode)
+        transformed = perf_counter()
+        es.transfer_data(actions=batch_documents)
+        loaded = perf_counter()
+
+        documents += len(batch_documents)
+        timings['extract'].append(extracted - started)
+        timings['transform'].append(transformed - extracted)
+        timings['load'].append(loaded - transformed)
+    return {'documents': documents, 'timings': timings}
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def report(result: dict) -> None:
+    documents = result['documents']
+    print(f'{"stage":>10} {"total, s":>9} {"docs/sec":>10} '
+          f'{"p50, ms":>8} {"p95, ms":>8} {"max, ms":>8}')
+    total = 0.0
+    for stage in STAGES:
+        values = result['timings'][stage]
+        elapsed = sum(values)
+        total += elapsed
+        print(f'{stage:>10} {elapsed:>9.3f} '
+              f'{documents / elapsed if elapsed else 0:>10.0f} '
+              f'{percentile(values, 50) * 1000:>8.1f} '
+              f'{percentile(values, 95) * 1000:>8.1f} '
+              f'{max(values, default=0) * 1000:>8.1f}')
+    print(f'{"total":>10} {total:>9.3f} '
+          f'{documents / total if total else 0:>10.0f}')
+    print(f'{documents} documents in {len(result["timings"]["load"])} '
+          f'batches')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', default='synthetic',
+                        choices=('synthetic', 'fixture', 'postgres'))
+    parser.add_argument('--mode', default='rows',
+                        choices=('rows', 'aggregate'),
+                        help='режим извлечения из PostgreSQL')
+    parser.add_argument('--fixture', help='фикстура строк выборки')
+    parser.add_argument('--films', type=int, default=5000)
+    parser.add_argument('--persons', type=int, default=2500)
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--batch', type=int, default=100,
+                        help='фильмов в пакете')
+    parser.add_argument('--real-es', action='store_true',
+                        help='загружать в Elasticsearch из .env')
+    parser.add_argument('--es-latency', type=float, default=0.0)
+    parser.add_argument('--es-per-document', type=float, default=0.0)
+    args = parser.parse_args()
+
+    pg = None
+    if args.source == 'postgres':
+        pg = PostgresService()
+        batches = postgres_batches(pg=pg, batch=args.batch, mode=args.mode)
+    else:
+        args.mode = 'rows'
+        if args.source == 'fixture':
+            rows = read_fixture(args.fixture)
+        else:
+            rows = catalogue_rows(generate_catalogue(
+                films=args.films, persons=args.persons, genres=args.genres,
+                skew=args.skew))
+        batches = row_batches(rows=rows, batch=args.batch)
+
+    try:
+        if args.real_es:
+            es = ElasticsearchService()
+            report(run(batches=batches, es=es, mode=args.mode))
+            es.close()
+            return
+        with FakeElasticsearch(latency=args.es_latency,
+                               per_document=args.es_per_document) as server:
+            es = ElasticsearchService(settings=es_settings.copy(update={
+                'ES_HOST': server.host, 'ES_PORT': server.port}))
+            report(run(batches=batches, es=es, mode=args.mode))
+            es.close()
+            stats = server.stats
+            print(f'fake Elasticsearch: {stats.requests} bulk requests, '
+                  f'{stats.bytes} bytes, p50 '
+                  f'{percentile(stats.latencies, 50) * 1000:.1f} ms')
+    finally:
+        if pg is not None:
+            pg.close()
+
+
+if __name__ == '__main__':
+    main()
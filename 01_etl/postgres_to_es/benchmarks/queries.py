@@ -0,0 +1,78 @@
+"""
+Бенчмарк запроса filmwork_by_id: строковый SQL против подготовленного.
+
+Сравнивает прежний вариант (ID подставляются в текст запроса как
+IN (...), каждый раз новый разбор и планирование) с подготовленным
+оператором с параметром = ANY($1::uuid[]). Для каждого размера списка ID
+выводит длину текста запроса, время планирования по EXPLAIN и
+время полного обращения к серверу.
+
+Запуск из каталога postgres_to_es (нужен доступ к PostgreSQL из .env):
+    python -m benchmarks.queries --ids 10 100 1000 5000
+"""
+import argparse
+import re
+from time import perf_counter
+
+from services.pg import PostgresService, queries
+
+PLANNING_TIME = re.compile(r'Planning Time: ([\d.]+) ms')
+
+
+def legacy_filmwork_by_id(ids: tuple) -> str:
+    """Прежний запрос с подстановкой ID в текст"""
+    condition = f"IN {tuple(ids)}" if len(ids) > 1 else f"= '{ids[0]}'"
+    return queries.filmwork_rows(where=f'WHERE fw.id {condition}')
+
+
+def planning_time(pg: PostgresService, statement: str, params=None) -> float:
+    """Время планирования запроса в миллисекундах по EXPLAIN ANALYZE"""
+    with pg.conn:
+        with pg.conn.cursor() as curs:
+            curs.execute(f'EXPLAIN (ANALYZE, SUMMARY) {statement}', params)
+            plan = '\n'.join(row[0] for row in curs.fetchall())
+    match = PLANNING_TIME.search(plan)
+    return float(match.group(1)) if match else 0.0
+
+
+def round_trip(pg: PostgresService, query, repeat: int) -> float:
+    """Среднее время выполнения запроса с получением результата, мс"""
+    started = perf_counter()
+    for _ in range(repeat):
+        pg.executor(query=query)
+    return (perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ids', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    pg = PostgresService()
+    try:
+        print(f'{"ids":>6} {"variant":>9} {"sql bytes":>10} '
+              f'{"planning, ms":>13} {"round trip, ms":>15}')
+        for size in args.ids:
+            ids = tuple(row['id'] for row in pg.executor(
+                f'SELECT id FROM content.film_work ORDER BY id '
+                f'LIMIT {size};'))
+            legacy = legacy_filmwork_by_id(ids)
+            prepared = queries.filmwork_by_id(ids)
+            """Первые выполнения прогревают подготовленный оператор"""
+            round_trip(pg, prepared, repeat=6)
+
+            print(f'{len(ids):>6} {"legacy":>9} {len(legacy):>10} '
+                  f'{planning_time(pg, legacy):>13.3f} '
+                  f'{round_trip(pg, legacy, args.repeat):>15.3f}')
+            execute = f'EXECUTE {prepared.name} (%s::uuid[])'
+            print(f'{len(ids):>6} {"prepared":>9} {len(prepared.text):>10} '
+                  f'{planning_time(pg, execute, prepared.params):>13.3f} '
+                  f'{round_trip(pg, prepared, args.repeat):>15.3f}')
+    finally:
+        pg.close()
+
+
+if __name__ == '__main__':
+    main()
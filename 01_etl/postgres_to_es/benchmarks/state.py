@@ -0,0 +1,61 @@
+"""
+Бенчмарк хранилищ состояния: количество вызовов set_state в секунду.
+
+Каждый вызов сохраняет курсоры источников изменений в том виде, в каком
+их сохраняет ETL. Хранилища создаются во временном каталоге.
+
+Запуск из каталога postgres_to_es:
+    python -m benchmarks.state --operations 2000
+"""
+import argparse
+import tempfile
+import uuid
+from datetime import datetime
+from time import perf_counter
+
+from services.etl import State, get_storage
+
+
+def make_states(seq: int) -> dict:
+    """Состояние ETL с курсорами источников и незавершенным разворотом"""
+    cursor = {'modified': f'{datetime.now()}', 'id': str(uuid.uuid4())}
+    return {
+        'person': cursor, 'genre': cursor, 'filmwork': cursor,
+        'fanout': {'genre': {'ids': [str(uuid.uuid4()) for _ in range(10)],
+                             'after': str(uuid.uuid4()), 'cursor': cursor,
+                             'full_page': False}},
+        'seq': seq,
+    }
+
+
+def measure(backend: str, operations: int) -> float:
+    """Возвращает количество операций set_state в секунду"""
+    with tempfile.TemporaryDirectory() as file_path:
+        storage = get_storage(backend=backend, file_path=f'{file_path}/',
+                              file_name='state.json')
+        state = State(storage=storage)
+        started = perf_counter()
+        for seq in range(operations):
+            state.set_state('modified', make_states(seq))
+        storage.close()
+        elapsed = perf_counter() - started
+        assert State(storage=get_storage(
+            backend=backend, file_path=f'{file_path}/',
+            file_name='state.json')).get_state('modified')['seq'] == seq
+    return operations / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--operations', type=int, default=2000)
+    parser.add_argument('--backends', nargs='+',
+                        default=['json', 'memory', 'sqlite'])
+    args = parser.parse_args()
+
+    print(f'{"backend":>8} {"set_state ops/sec":>18}')
+    for backend in args.backends:
+        print(f'{backend:>8} {measure(backend, args.operations):>18.0f}')
+
+
+if __name__ == '__main__':
+    main()
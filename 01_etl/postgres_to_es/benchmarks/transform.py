@@ -0,0 +1,117 @@
+"""
+Микро-бенчмарк трансформации строк выборки фильмов.
+
+Сравнивает прежнюю реализацию ETL.transform (вложенный перебор строк для
+каждого фильма) с однопроходной transform_filmworks.
+
+Запуск из каталога postgres_to_es:
+    python -m benchmarks.transform --films 100 500 1000 2000
+"""
+import argparse
+import random
+import uuid
+from time import perf_counter
+from typing import Callable, Iterable
+
+from services.etl.transform import transform_filmworks
+
+ROLES = ('actor', 'writer', 'director')
+
+
+def generate_rows(films: int, persons: int, genres: int) -> list[dict]:
+    """
+    Формирует декартово произведение строк film_work × person × genre,
+    как его возвращает запрос filmwork_by_id
+    """
+    random.seed(films)
+    genre_names = [f'genre-{i}' for i in range(genres * 4)]
+    rows: list[dict] = []
+    for film in range(films):
+        fw_id = str(uuid.uuid4())
+        film_persons = [(str(uuid.uuid4()), f'person-{film}-{i}',
+                         random.choice(ROLES)) for i in range(persons)]
+        for person_id, full_name, role in film_persons:
+            for genre in random.sample(genre_names, genres):
+                rows.append({
+                    'fw_id': fw_id, 'title': f'title-{film}',
+                    'description': None, 'rating': 7.5, 'role': role,
+                    'person_id': person_id, 'full_name': full_name,
+                    'genre': genre,
+                })
+    return sorted(rows, key=lambda row: row['fw_id'])
+
+
+def legacy_transform(modified_data: list[dict]) -> list[dict]:
+    """Прежняя реализация ETL.transform без валидации pydantic"""
+    transformed_data: list = []
+    filmwork_ids: set = {filmwork.get('fw_id') for filmwork in modified_data}
+    for filmwork_id in filmwork_ids:
+        genres, directors, actors_names, writers_names = [], [], [], []
+        actors, writers = [], []
+        for filmwork in modified_data:
+            if filmwork.get('fw_id') == filmwork_id:
+                if filmwork.get('genre') not in genres:
+                    genres.append(filmwork.get('genre'))
+                person_name = filmwork.get('full_name')
+                person_instance = {'id': filmwork.get('person_id'),
+                                   'name': person_name}
+                if filmwork.get('role') == 'director':
+                    if person_name not in directors:
+                        directors.append(person_name)
+                elif filmwork.get('role') == 'actor':
+                    if person_name not in actors_names:
+                        actors_names.append(person_name)
+                    if person_instance not in actors:
+                        actors.append(person_instance)
+                elif filmwork.get('role') == 'writer':
+                    if person_name not in writers_names:
+                        writers_names.append(person_name)
+                    if person_instance not in writers:
+                        writers.append(person_instance)
+                new_filmwork = {
+                    'id': filmwork_id,
+                    'imdb_rating': filmwork.get('rating'),
+                    'title': filmwork.get('title'),
+                    'description': filmwork.get('description'),
+                    'genre': genres, 'director': directors,
+                    'actors_names': actors_names,
+                    'writers_names': writers_names,
+                    'actors': actors, 'writers': writers,
+                }
+        transformed_data.append(new_filmwork)
+    return transformed_data
+
+
+def measure(func: Callable[[list], Iterable], rows: list,
+            repeat: int) -> float:
+    """Возвращает лучшее время выполнения из repeat запусков"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = perf_counter()
+        for _ in func(rows):
+            pass
+        best = min(best, perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--films', type=int, nargs='+',
+                        default=[100, 500, 1000, 2000])
+    parser.add_argument('--persons', type=int, default=10)
+    parser.add_argument('--genres', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"films":>8} {"rows":>8} {"legacy, s":>12} '
+          f'{"single-pass, s":>15} {"speedup":>9}')
+    for films in args.films:
+        rows = generate_rows(films, args.persons, args.genres)
+        legacy = measure(legacy_transform, rows, args.repeat)
+        single_pass = measure(transform_filmworks, rows, args.repeat)
+        print(f'{films:>8} {len(rows):>8} {legacy:>12.4f} '
+              f'{single_pass:>15.4f} {legacy / single_pass:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 
 from dotenv import load_dotenv
 from pydantic import BaseSettings
@@ -14,6 +14,8 @@ class PostgresSettings(BaseSettings):
     DB_HOST: Optional[str] = 'localhost'
     DB_PORT: Optional[int] = 5432
     DB_OPTIONS: str
+    DB_POOL_MIN: Optional[int] = 1
+    DB_POOL_MAX: Optional[int] = 4
 
     class Config:
         env_file = '.env'
@@ -25,6 +27,18 @@ class ElasticsearchSettings(BaseSettings):
     ES_PORT: Optional[int] = 9200
     ES_INDEX: str
     ES_SCHEMA: str
+    ES_INDEXES: Optional[str] = ''
+    ES_BULK_THREADS: Optional[int] = 4
+    ES_BULK_CHUNK_SIZE: Optional[int] = 500
+    ES_BULK_QUEUE_SIZE: Optional[int] = 4
+    ES_BULK_MAX_RETRIES: Optional[int] = 3
+    ES_BULK_ADAPTIVE: Optional[bool] = True
+    ES_BULK_MIN_CHUNK_SIZE: Optional[int] = 50
+    ES_BULK_MAX_CHUNK_SIZE: Optional[int] = 5000
+    ES_BULK_MAX_BYTES: Optional[int] = 10 * 1024 * 1024
+    ES_BULK_TARGET_LATENCY: Optional[float] = 1.0
+    ES_BULK_RETRY_BASE: Optional[float] = 0.5
+    ES_BULK_RETRY_CAP: Optional[float] = 30.0
 
     class Config:
         env_file = '.env'
@@ -33,9 +47,47 @@ class ElasticsearchSettings(BaseSettings):
 class ETLSettings(BaseSettings):
     """Параметры настроек для ETL"""
     LIMIT: Optional[int] = 100
+    EXTRACT_MODE: Literal['rows', 'aggregate'] = 'rows'
+    FETCH_SIZE: Optional[int] = 2000
+    FANOUT_LIMIT: Optional[int] = 500
+    PARTIAL_UPDATES: Optional[bool] = True
+    PIPELINE_MODE: Optional[bool] = False
+    PIPELINE_QUEUE_SIZE: Optional[int] = 2
     UPLOAD_INTERVAL: float
+    NOTIFY_ENABLED: Optional[bool] = False
+    NOTIFY_CHANNEL: Optional[str] = 'etl_changes'
+    NOTIFY_DEBOUNCE: Optional[float] = 0.2
+    NOTIFY_MAX_DELAY: Optional[float] = 2.0
+    BREAKER_FAILURE_THRESHOLD: Optional[int] = 5
+    BREAKER_RESET_TIMEOUT: Optional[float] = 30.0
     STATE_FIELD: str
     STATE_FILE_NAME: str
+    STATE_BACKEND: Literal['json', 'memory', 'sqlite'] = 'json'
+    STATE_SQLITE_FILE_NAME: str = 'state.sqlite3'
+    STATE_FLUSH_INTERVAL: Optional[float] = 1.0
+    SHARDS: Optional[int] = 0
+    LEASE_TTL: Optional[float] = 300
+    WORKER_ID: Optional[str] = None
+    DIGEST_ENABLED: Optional[bool] = True
+    DIGEST_FILE_NAME: Optional[str] = 'digests.sqlite3'
+    NAMES_FILE_NAME: Optional[str] = 'names.sqlite3'
+    DLQ_ENABLED: Optional[bool] = True
+    DLQ_DIR_NAME: Optional[str] = 'dlq'
+    DLQ_SEGMENT_BYTES: Optional[int] = 8 * 1024 * 1024
+    DLQ_MAX_SEGMENTS: Optional[int] = 100
+    DIMENSION_CACHE_ENABLED: Optional[bool] = True
+    DIMENSION_CACHE_SIZE: Optional[int] = 100000
+    DIMENSION_CACHE_TTL: Optional[float] = 3600
+    RECONCILE_INTERVAL: Optional[int] = 0
+    RECONCILE_LEAF_SIZE: Optional[int] = 1000
+    RECONCILE_MAX_DEPTH: Optional[int] = 6
+    PROFILE_SIGNAL: Optional[str] = 'SIGUSR1'
+    PROFILE_CONTROL_FILE: Optional[str] = 'profile.request'
+    PROFILE_CYCLES: Optional[int] = 3
+    PROFILE_TOP: Optional[int] = 30
+    PROFILE_MEMORY: Optional[bool] = True
+    METRICS_PORT: Optional[int] = 0
+    METRICS_ADDR: Optional[str] = '0.0.0.0'
 
     class Config:
         env_file = '.env'
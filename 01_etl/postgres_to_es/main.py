@@ -1,9 +1,21 @@
+import argparse
 import logging
+import os
+import socket
+from functools import partial
 from pathlib import Path
+from time import sleep, time
 
 from config.settings import etl_settings
-from services.etl import JsonFileStorage, State
+from services.etl import CircuitOpenError, State, get_storage
+from services.etl.lease import (Heartbeat, LeaseLost, LeaseManager,
+                                PostgresStorage)
+from services.etl.metrics import start_metrics_server
+from services.etl.pipeline import Pipeline
+from services.etl.backoff import decorrelated_jitter
+from services.etl.runtime import SERVICE_ERRORS, Runtime
 from services.etl.service import ETL
+from services.pg import PostgresService
 
 """Настройка логирования"""
 _log_format = ("%(asctime)s - [%(levelname)s] - %(name)s "
@@ -16,38 +28,278 @@ logger = logging.getLogger(__name__)
 
 """Хранилище состояний"""
 default_file_path: str = f'{Path(__file__).resolve().parent}'
-storage = JsonFileStorage(file_path=default_file_path,
-                          file_name=etl_settings.STATE_FILE_NAME)
+storage = get_storage(backend=etl_settings.STATE_BACKEND,
+                      file_path=default_file_path,
+                      file_name=etl_settings.STATE_FILE_NAME)
 
 
-def load_to_es():
-    etl_state = State(storage=storage)
-
-    if etl_state.get_state('etl_process') == 'started':
+def acquire_lock() -> bool:
+    """
+    Отмечает запуск процесса ETL. Другой процесс считается запущенным,
+    пока его heartbeat моложе LEASE_TTL, поэтому после аварийного
+    завершения блокировка снимается сама. Пока блокировка взята,
+    heartbeat обновляет фоновый поток (Heartbeat)
+    """
+    state = State(storage=storage)
+    heartbeat = state.get_state('etl_heartbeat') or 0
+    if (state.get_state('etl_process') == 'started'
+            and time() - heartbeat < etl_settings.LEASE_TTL):
         logger.error('ETL process already started, please stop it before run!')
-        return
+        return False
+    state.set_state('etl_process', 'started')
+    state.set_state('etl_heartbeat', time())
+    return True
+
+
+def touch_lock() -> None:
+    """Обновляет heartbeat блокировки процесса"""
+    State(storage=storage).set_state('etl_heartbeat', time())
+
+
+def release_lock() -> None:
+    State(storage=storage).set_state('etl_process', 'stopped')
+
+
+def full_reindex(blue_green: bool = True):
+    """Полная потоковая переиндексация каталога фильмов"""
+    with Runtime() as runtime:
+        with ETL(runtime=runtime, state=State(storage=storage)) as etl:
+            etl.full_reindex(blue_green=blue_green)
+
+
+def replay_dlq():
+    """Повторная загрузка документов из журнала отказов"""
+    with Runtime() as runtime:
+        if runtime.dlq is None:
+            logger.error('Dead letter queue is disabled (DLQ_ENABLED)')
+            return
+        with ETL(runtime=runtime, state=State(storage=storage)) as etl:
+            etl.replay_dead_letters()
 
+
+def reconcile():
+    """Сверка индекса с PostgreSQL и исправление расхождений"""
+    with Runtime() as runtime:
+        with ETL(runtime=runtime, state=State(storage=storage)) as etl:
+            etl.reconcile()
+
+
+def run_cycle(etl: ETL) -> None:
+    """Обрабатывает страницу за страницей все накопленные изменения"""
+    profiler = etl.profiler
     while True:
-        with ETL(state=State(storage=storage)) as etl:
-            logger.info('Start extract data from PostgreSQL')
+        logger.info('Start extract data from PostgreSQL')
+        with profiler.stage('extract'):
             number_data, modified_data = etl.extract()
 
-            logger.info('Extracted %d modified data', number_data)
+        logger.info('Extracted %d modified data', number_data)
 
-            if modified_data is not None:
-                transformed_data = etl.transform(modified_data=modified_data)
+        if modified_data is not None:
+            with profiler.stage('transform'):
+                transformed_data = profiler.materialize(etl.skip_unchanged(
+                    etl.transform(modified_data=modified_data)))
 
-                logger.info('Start data transfer to Elasticsearch')
+            logger.info('Start data transfer to Elasticsearch')
+            with profiler.stage('load'):
                 etl.load(transformed_data=transformed_data)
+        else:
+            logger.info('No data to load into Elasticsearch')
+
+        etl.apply_updates(updates=etl.updates)
+        etl.load_indexes(changes=etl.changes)
+
+        logger.info('Save state of data modified')
+        etl.save_state()
+
+        """Выходим на паузу только после обработки всех изменений"""
+        if etl.caught_up:
+            break
+
+
+def wait_for_circuit(error: CircuitOpenError) -> None:
+    """
+    Сервис недоступен: цикл прерван без сохранения состояния и будет
+    повторен, когда размыкатель пропустит пробный запрос
+    """
+    logger.warning('%s, next cycle in %.1f seconds', error,
+                   error.retry_after)
+    sleep(error.retry_after)
+
 
-                logger.info('Save state of data modified')
-                etl.save_state()
+def wait_for_services(error: Exception, delay: float) -> float:
+    """
+    Ошибка сервиса до размыкания цепи: цикл прерван без сохранения
+    состояния и будет повторен после паузы decorrelated jitter. Ошибки
+    уже учтены размыкателем сервиса, поэтому повторяющиеся сбои
+    размыкают цепь. Возвращает паузу для расчета следующей
+    """
+    delay = decorrelated_jitter(previous=delay,
+                                base=etl_settings.ES_BULK_RETRY_BASE,
+                                cap=etl_settings.BREAKER_RESET_TIMEOUT)
+    logger.warning('Service error: %s, next cycle in %.1f seconds',
+                   error, delay)
+    sleep(delay)
+    return delay
+
+
+def install_triggers():
+    """
+    Устанавливает триггеры уведомлений об изменениях таблиц каталога.
+    DDL выполняется один раз при развертывании, а не при каждом запуске
+    """
+    pg_client = PostgresService()
+    try:
+        pg_client.install_notify_triggers(
+            channel=etl_settings.NOTIFY_CHANNEL)
+    finally:
+        pg_client.close()
+
+
+def serve_metrics() -> None:
+    """
+    Метрики отдают только долгоживущие режимы: разовые команды
+    не занимают порт работающего процесса
+    """
+    if etl_settings.METRICS_PORT:
+        start_metrics_server(port=etl_settings.METRICS_PORT,
+                             addr=etl_settings.METRICS_ADDR)
+
+
+def load_to_es():
+    serve_metrics()
+    with Runtime() as runtime:
+        delay = 0.0
+        while True:
+            try:
+                with runtime.profiler.cycle(), ETL(
+                        runtime=runtime, state=State(storage=storage)) as etl:
+                    if etl_settings.PIPELINE_MODE:
+                        Pipeline(etl=etl).run()
+                    else:
+                        run_cycle(etl)
+                    if etl.reconcile_due:
+                        etl.reconcile()
+            except CircuitOpenError as error:
+                wait_for_circuit(error)
+                continue
+            except SERVICE_ERRORS as error:
+                delay = wait_for_services(error, delay=delay)
+                continue
+            delay = 0.0
+
+            runtime.wait_for_changes(timeout=etl_settings.UPLOAD_INTERVAL)
+
+
+def load_shard(runtime: Runtime, leases: LeaseManager, pg_client,
+               shard: int) -> None:
+    """Обрабатывает изменения одного арендованного шарда"""
+    state = State(storage=PostgresStorage(pg_client=pg_client,
+                                          name=f'shard-{shard}',
+                                          fence=(shard, leases.owner)))
+    try:
+        with ETL(runtime=runtime, state=state,
+                 shard=(shard, etl_settings.SHARDS),
+                 on_heartbeat=partial(leases.renew, shard)) as etl:
+            if etl_settings.PIPELINE_MODE:
+                Pipeline(etl=etl).run()
             else:
-                logger.info('No data to load into Elasticsearch')
+                run_cycle(etl)
+    except LeaseLost as error:
+        logger.warning('%s', error)
+
+
+def load_shards_to_es():
+    """
+    Режим нескольких процессов: фильмы разбиты на SHARDS шардов по хешу
+    ID, каждый процесс арендует свою долю шардов и хранит их состояние
+    в PostgreSQL. Шарды упавшего процесса забираются после истечения
+    аренды и продолжают обработку с сохраненного курсора
+    """
+    serve_metrics()
+    owner = etl_settings.WORKER_ID or f'{socket.gethostname()}-{os.getpid()}'
+    shards = etl_settings.SHARDS
+    with Runtime() as runtime:
+        pg_client = runtime.postgres()
+        leases = LeaseManager(pg_client=pg_client, shards=shards,
+                              owner=owner, ttl=etl_settings.LEASE_TTL)
+        try:
+            leases.setup()
+            delay = 0.0
+            while True:
+                try:
+                    if not pg_client.is_alive():
+                        pg_client.reconnect()
+                    owned = leases.rebalance()
+                    logger.info('Worker %s owns shards %s', owner, owned)
+                    with runtime.profiler.cycle():
+                        for shard in owned:
+                            load_shard(runtime=runtime, leases=leases,
+                                       pg_client=pg_client, shard=shard)
+                except CircuitOpenError as error:
+                    wait_for_circuit(error)
+                    continue
+                except SERVICE_ERRORS as error:
+                    delay = wait_for_services(error, delay=delay)
+                    continue
+                delay = 0.0
+
+                runtime.wait_for_changes(
+                    timeout=etl_settings.UPLOAD_INTERVAL)
+        finally:
+            leases.release_all()
+            pg_client.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Перенос данных из PostgreSQL в Elasticsearch')
+    parser.add_argument('--full-reindex', action='store_true',
+                        help='переиндексировать весь каталог фильмов '
+                             'и завершить работу')
+    parser.add_argument('--in-place', action='store_true',
+                        help='при полной переиндексации загружать данные '
+                             'в рабочий индекс, а не в новую версию')
+    parser.add_argument('--replay-dlq', action='store_true',
+                        help='повторно загрузить документы из журнала '
+                             'отказов и завершить работу')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='сверить индекс с PostgreSQL, исправить '
+                             'расхождения и завершить работу')
+    parser.add_argument('--install-triggers', action='store_true',
+                        help='установить триггеры уведомлений об '
+                             'изменениях и завершить работу')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    try:
-        load_to_es()
-    except KeyboardInterrupt:
-        logger.info('ETL process interrupted')
+    args = parse_args()
+    if (etl_settings.SHARDS
+            and etl_settings.UPLOAD_INTERVAL >= etl_settings.LEASE_TTL):
+        logger.warning('UPLOAD_INTERVAL (%s) is not less than LEASE_TTL '
+                       '(%s): idle workers lose their shard leases',
+                       etl_settings.UPLOAD_INTERVAL, etl_settings.LEASE_TTL)
+    if args.install_triggers:
+        install_triggers()
+    elif etl_settings.SHARDS and not (args.full_reindex or args.replay_dlq
+                                      or args.reconcile):
+        try:
+            load_shards_to_es()
+        except KeyboardInterrupt:
+            logger.info('ETL process interrupted')
+    elif acquire_lock():
+        try:
+            with Heartbeat(beat=touch_lock,
+                           interval=etl_settings.LEASE_TTL / 3):
+                if args.full_reindex:
+                    full_reindex(blue_green=not args.in_place)
+                elif args.replay_dlq:
+                    replay_dlq()
+                elif args.reconcile:
+                    reconcile()
+                else:
+                    load_to_es()
+        except KeyboardInterrupt:
+            logger.info('ETL process interrupted')
+        finally:
+            release_lock()
+            storage.close()
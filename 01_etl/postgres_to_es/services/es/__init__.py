@@ -1 +1,2 @@
+from .batcher import *
 from .service import *
@@ -0,0 +1,65 @@
+import logging
+import threading
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AdaptiveBatcher']
+
+
+class AdaptiveBatcher:
+    """
+    Делит сериализованные действия bulk на пакеты, ограниченные числом
+    документов и объемом в байтах. Размер пакета подстраивается по
+    ответам Elasticsearch (AIMD): после быстрого пакета без отказов
+    растет на increase, после отказов 429 или медленного ответа
+    уменьшается в decrease раз
+    """
+
+    def __init__(self, chunk_size: int, min_size: int, max_size: int,
+                 max_bytes: int, target_latency: float,
+                 increase: int = 0, decrease: float = 0.5,
+                 adaptive: bool = True):
+        self.min_size = max(min_size, 1)
+        self.max_size = max(max_size, self.min_size)
+        self.chunk_size = min(max(chunk_size, self.min_size), self.max_size)
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.increase = increase or self.min_size
+        self.decrease = decrease
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+
+    def chunks(self, actions: Iterable[bytes]) -> Iterator[list[bytes]]:
+        """
+        Возвращает пакеты действий. Действие больше max_bytes
+        отправляется отдельным пакетом
+        """
+        chunk: list[bytes] = []
+        size = 0
+        for action in actions:
+            if chunk and (len(chunk) >= self.chunk_size
+                          or size + len(action) > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(action)
+            size += len(action) + 1
+        if chunk:
+            yield chunk
+
+    def observe(self, documents: int, latency: float, rejected: int) -> None:
+        """Подстраивает размер пакета по результату отправки"""
+        if not self.adaptive:
+            return
+        with self.lock:
+            previous = self.chunk_size
+            if rejected or latency > self.target_latency:
+                self.chunk_size = max(self.min_size,
+                                      int(self.chunk_size * self.decrease))
+            elif documents >= self.chunk_size:
+                self.chunk_size = min(self.max_size,
+                                      self.chunk_size + self.increase)
+            if self.chunk_size < previous:
+                logger.info('Bulk chunk size decreased to %d (rejected: %d, '
+                            'latency: %.2f s)', self.chunk_size, rejected,
+                            latency)
@@ -1,27 +1,126 @@
 import json
 import logging
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Iterable, Iterator, Optional
 
-from config.settings import es_settings
-from elasticsearch import Elasticsearch, helpers
-from services.etl import backoff
+from config.settings import es_settings, etl_settings
+from elasticsearch import ConnectionError as ESConnectionError
+from elasticsearch import Elasticsearch, TransportError, helpers
+from services.es.batcher import AdaptiveBatcher
+from services.etl import CircuitBreaker, backoff
+from services.etl.backoff import decorrelated_jitter
+from services.etl.metrics import (ES_BULK_CHUNK_SIZE, ES_BULK_SECONDS,
+                                  ES_DOCUMENTS)
 
 logger = logging.getLogger(__name__)
 es_log = logging.getLogger('elasticsearch')
 es_log.setLevel(logging.CRITICAL)
 
+"""
+Ошибки соединения: встроенная (проверка ping) и клиента Elasticsearch,
+включая таймауты
+"""
+CONNECTION_ERRORS = (ConnectionError, ESConnectionError)
+
+"""Роли фильма, в которых документ хранит ID персонажа"""
+PERSON_ROLES = ('actors', 'writers')
+
+"""Коды ответа перегруженного или недоступного кластера"""
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+es_breaker = CircuitBreaker(
+    name='elasticsearch',
+    failure_threshold=etl_settings.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=etl_settings.BREAKER_RESET_TIMEOUT)
+
+
+def is_unavailable(error: TransportError) -> bool:
+    """Запрос не дошел до кластера или кластер перегружен"""
+    return (isinstance(error, ESConnectionError)
+            or error.status_code in RETRY_STATUSES)
+
+
+"""
+Скрипт переименования персонажей: меняет имя во вложенных списках
+actors/writers по ID и заменяет прежнее имя в actors_names/writers_names
+"""
+RENAME_PERSONS_SCRIPT = """
+    boolean changed = false;
+    for (String role : params.roles) {
+        def persons = ctx._source[role];
+        def names = ctx._source[role + '_names'];
+        if (persons == null) {
+            continue;
+        }
+        for (def person : persons) {
+            String name = params.names[person.id];
+            if (name == null || name == person.name) {
+                continue;
+            }
+            if (names != null) {
+                int position = names.indexOf(person.name);
+                if (position >= 0) {
+                    names.set(position, name);
+                }
+            }
+            person.name = name;
+            changed = true;
+        }
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+"""
+
+"""Скрипт переименования жанров по словарю прежнее имя -> новое имя"""
+RENAME_GENRES_SCRIPT = """
+    def genres = ctx._source.genre;
+    boolean changed = false;
+    for (int i = 0; genres != null && i < genres.size(); i++) {
+        String name = params.renames[genres[i]];
+        if (name != null) {
+            genres[i] = name;
+            changed = true;
+        }
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+"""
+
 
 class ElasticsearchService:
     def __init__(self, settings=es_settings):
         self.host = settings.ES_HOST
         self.port = settings.ES_PORT
         self.index_name = settings.ES_INDEX
+        self.bulk_threads = settings.ES_BULK_THREADS
+        self.bulk_chunk_size = settings.ES_BULK_CHUNK_SIZE
+        self.bulk_queue_size = settings.ES_BULK_QUEUE_SIZE
+        self.bulk_max_retries = settings.ES_BULK_MAX_RETRIES
+        self.bulk_retry_base = settings.ES_BULK_RETRY_BASE
+        self.bulk_retry_cap = settings.ES_BULK_RETRY_CAP
+        self.batcher = AdaptiveBatcher(
+            chunk_size=settings.ES_BULK_CHUNK_SIZE,
+            min_size=settings.ES_BULK_MIN_CHUNK_SIZE,
+            max_size=settings.ES_BULK_MAX_CHUNK_SIZE,
+            max_bytes=settings.ES_BULK_MAX_BYTES,
+            target_latency=settings.ES_BULK_TARGET_LATENCY,
+            adaptive=settings.ES_BULK_ADAPTIVE)
+        self.encoder = json.JSONEncoder(ensure_ascii=False,
+                                        separators=(',', ':'), default=str)
         self.client = Elasticsearch([{'host': self.host, 'port': self.port}])
         self.status = True if self.__get_status_connect() else False
         self.schema = self.__get_schema(file_path=settings.ES_SCHEMA)
+        self.schemas: dict[str, Optional[dict]] = {
+            self.index_name: self.schema}
         self.indexes = self.get_indexes()
 
-    @backoff(exception=ConnectionError)
+    @backoff(exception=CONNECTION_ERRORS)
     def __get_status_connect(self):
         logger.info('Connecting to Elasticsearch ...')
         if not self.client.ping():
@@ -38,35 +137,421 @@ class ElasticsearchService:
             logger.warning("Index schema file '%s' not found", file_path)
             return None
 
-    @backoff(exception=ConnectionError)
+    @backoff(exception=CONNECTION_ERRORS)
     def get_indexes(self) -> list:
+        """
+        Возвращает список индексов и псевдонимов и создает рабочий индекс
+        при его отсутствии. Вызывается один раз, результат хранится
+        в self.indexes
+        """
         logger.info('Get indexes')
-        indexes = list(self.client.indices.get_alias().keys())
+        aliases = self.client.indices.get_alias()
+        indexes = list(aliases.keys()) + [
+            alias for index in aliases.values()
+            for alias in index.get('aliases', {})
+        ]
         if self.index_name not in indexes:
             self.create_index(self.index_name)
+            indexes.append(self.index_name)
+        elif self.schema:
+            """Новые поля схемы добавляются в существующий индекс"""
+            self.client.indices.put_mapping(index=self.index_name,
+                                            body=self.schema['mappings'])
         return indexes
 
+    @backoff(exception=CONNECTION_ERRORS)
+    def ensure_index(self, index_name: str, schema_path: str) -> None:
+        """
+        Регистрирует схему дополнительного индекса и создает индекс при
+        его отсутствии. Существующему индексу добавляются новые поля схемы
+        """
+        schema = self.schemas[index_name] = self.__get_schema(
+            file_path=schema_path)
+        if index_name not in self.indexes:
+            self.create_index(index_name=index_name, schema=schema)
+            self.indexes.append(index_name)
+        elif schema:
+            self.client.indices.put_mapping(index=index_name,
+                                            body=schema['mappings'])
+
     def close(self):
         self.client.transport.close()
         logger.info('Elasticsearch connection closed')
 
-    def create_index(self, index_name: str):
-        if body := self.schema:
+    def is_alive(self) -> bool:
+        """Проверяет, что Elasticsearch доступен"""
+        return self.client.ping()
+
+    def reconnect(self):
+        """Пересоздает клиент Elasticsearch после потери связи"""
+        self.close()
+        self.client = Elasticsearch([{'host': self.host, 'port': self.port}])
+        with es_breaker.guard(CONNECTION_ERRORS):
+            self.status = True if self.__get_status_connect() else False
+
+    def create_index(self, index_name: str, settings: Optional[dict] = None,
+                     schema: Optional[dict] = None):
+        if body := schema or self.schema:
+            if settings:
+                body = {**body, 'settings': {**body.get('settings', {}),
+                                             **settings}}
             self.client.indices.create(index=index_name, body=body)
             logger.info(f"Index '{index_name}' created")
         else:
             logger.warning(
                 "Index '%s' not created, missing schema", index_name)
 
-    @backoff(exception=ConnectionError)
-    def transfer_data(self, actions) -> None:
-        """Добавляет пакеты данных в Elasticsearch"""
-        success, failed = helpers.bulk(
-            client=self.client,
-            actions=[
-                {'_index': self.index_name, '_id': action.get('id'), **action}
-                for action in actions
-            ],
-            stats_only=True
+    def delete_index(self, index_name: str) -> None:
+        """Удаляет индекс, например недогруженную версию рабочего индекса"""
+        self.client.indices.delete(index=index_name, ignore_unavailable=True)
+        logger.info("Index '%s' deleted", index_name)
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def create_versioned_index(self, alias: Optional[str] = None) -> str:
+        """
+        Создает новую версию рабочего индекса (по умолчанию фильмов)
+        с настройками для быстрой загрузки: без обновления поиска
+        и без реплик. Версия - время создания с точностью до микросекунд,
+        поэтому повторная попытка сразу после неудачной получает новое имя
+        """
+        alias = alias or self.index_name
+        index_name = f'{alias}_{datetime.now():%Y%m%d%H%M%S%f}'
+        self.create_index(index_name=index_name,
+                          settings={'refresh_interval': '-1',
+                                    'number_of_replicas': 0},
+                          schema=self.schemas.get(alias))
+        return index_name
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def promote_index(self, index_name: str,
+                      alias: Optional[str] = None) -> None:
+        """
+        Возвращает новой версии индекса рабочие настройки, объединяет
+        сегменты и атомарно переключает на нее псевдоним рабочего индекса
+        (по умолчанию фильмов). Предыдущие версии удаляются после
+        переключения
+        """
+        alias = alias or self.index_name
+        settings = (self.schemas.get(alias) or {}).get('settings', {})
+        self.client.indices.put_settings(index=index_name, body={'index': {
+            'refresh_interval': settings.get('refresh_interval', '1s'),
+            'number_of_replicas': settings.get('number_of_replicas', 1),
+        }})
+        self.client.indices.refresh(index=index_name)
+        logger.info("Force merge of index '%s' ...", index_name)
+        self.client.indices.forcemerge(index=index_name, max_num_segments=1,
+                                       request_timeout=3600)
+
+        actions: list[dict] = [{'add': {'index': index_name, 'alias': alias}}]
+        previous: list[str] = []
+        if self.client.indices.exists_alias(name=alias):
+            previous = list(self.client.indices.get_alias(name=alias))
+            actions = [{'remove': {'index': index, 'alias': alias}}
+                       for index in previous] + actions
+        elif self.client.indices.exists(index=alias):
+            """Рабочий индекс без псевдонима удаляется в той же операции"""
+            actions = [{'remove_index': {'index': alias}}] + actions
+        self.client.indices.update_aliases(body={'actions': actions})
+        logger.info("Alias '%s' switched to index '%s'", alias, index_name)
+
+        for index in previous:
+            if index != index_name:
+                self.client.indices.delete(index=index)
+                logger.info("Previous index '%s' deleted", index)
+        self.indexes = self.get_indexes()
+
+    @property
+    def window_size(self) -> int:
+        """
+        Количество документов, которое загрузчик держит в работе
+        одновременно: по пакету текущего размера на каждый поток
+        и на каждое место в очереди
+        """
+        return (self.batcher.chunk_size * max(self.bulk_threads, 1)
+                * max(self.bulk_queue_size, 1))
+
+    def serialize_actions(self, documents: Iterable[dict],
+                          index_name: Optional[str] = None
+                          ) -> Iterator[bytes]:
+        """
+        Сериализует документы сразу в действия индексации формата NDJSON:
+        строка метаданных и строка документа. Строка метаданных собирается
+        по шаблону, промежуточные словари действий не создаются.
+        Размер действия в байтах нужен для ограничения объема пакета
+        """
+        encode = self.encoder.encode
+        index_name = index_name or self.index_name
+        prefix = f'{{"index":{{"_index":{encode(index_name)},"_id":'
+        for document in documents:
+            yield (f'{prefix}{encode(document["id"])}}}}}\n'
+                   f'{encode(document)}').encode()
+
+    def send_chunk(self, chunk: list[bytes]) -> list[tuple[bool, dict]]:
+        """
+        Отправляет пакет одним запросом _bulk. Повторно (не больше
+        ES_BULK_MAX_RETRIES раз, с паузой decorrelated jitter)
+        отправляются только действия, отклоненные из-за перегрузки
+        (429, 502-504), или весь пакет, если запрос не дошел до кластера.
+        Задержка и число отказов каждого запроса передаются батчеру для
+        подстройки размера пакета
+        """
+        results: list[tuple[bool, dict]] = []
+        delay = 0.0
+        for attempt in range(self.bulk_max_retries + 1):
+            if attempt:
+                delay = decorrelated_jitter(previous=delay,
+                                            base=self.bulk_retry_base,
+                                            cap=self.bulk_retry_cap)
+                logger.warning('Retry %d of %d: %d bulk actions in %.2f s',
+                               attempt, self.bulk_max_retries, len(chunk),
+                               delay)
+                sleep(delay)
+            started = perf_counter()
+            try:
+                with es_breaker.guard(TransportError,
+                                      is_failure=is_unavailable):
+                    response = self.client.bulk(
+                        body=b'\n'.join(chunk) + b'\n')
+            except TransportError as error:
+                if (not is_unavailable(error)
+                        or attempt == self.bulk_max_retries):
+                    raise
+                logger.warning('Bulk request failed: %s', error)
+                self.batcher.observe(documents=len(chunk),
+                                     latency=perf_counter() - started,
+                                     rejected=len(chunk))
+                continue
+            latency = perf_counter() - started
+
+            retry: list[bytes] = []
+            rejected = 0
+            for action, item in zip(chunk, response['items']):
+                operation, result = next(iter(item.items()))
+                status = result.get('status', 500)
+                if status in RETRY_STATUSES:
+                    rejected += 1
+                    if attempt < self.bulk_max_retries:
+                        retry.append(action)
+                        continue
+                results.append((200 <= status < 300, item))
+            self.batcher.observe(documents=len(chunk), latency=latency,
+                                 rejected=rejected)
+            ES_BULK_SECONDS.observe(latency)
+            ES_DOCUMENTS.labels('rejected').inc(rejected)
+            ES_BULK_CHUNK_SIZE.set(self.batcher.chunk_size)
+            if not (chunk := retry):
+                break
+        return results
+
+    def bulk(self, actions: Iterable[bytes]) -> Iterator[tuple[bool, dict]]:
+        """
+        Отправляет действия в Elasticsearch пакетами адаптивного размера.
+        При нескольких потоках пакеты отправляются параллельно, число
+        пакетов в работе ограничено числом потоков и размером очереди.
+        Результаты возвращаются в порядке пакетов
+        """
+        chunks = self.batcher.chunks(actions)
+        if self.bulk_threads <= 1:
+            for chunk in chunks:
+                yield from self.send_chunk(chunk)
+            return
+
+        in_flight = self.bulk_threads + max(self.bulk_queue_size, 0)
+        with ThreadPoolExecutor(max_workers=self.bulk_threads,
+                                thread_name_prefix='es-bulk') as executor:
+            pending: deque = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(self.send_chunk, chunk))
+                if len(pending) >= in_flight:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def transfer_data(self, actions: Iterable[dict],
+                      index_name: Optional[str] = None
+                      ) -> tuple[list[str], list[dict]]:
+        """
+        Добавляет пакеты данных в Elasticsearch (по умолчанию в рабочий
+        индекс).
+        Результат проверяется по каждому документу, ошибки логируются
+        вместе с ID документа. Повторы выполняются по пакетам и
+        действиям, а не для всего вызова. Возвращает ID документов,
+        загрузку которых подтвердил Elasticsearch, и список отказов
+        (ID, статус, причина)
+        """
+        succeeded, failures = [], []
+        for ok, item in self.bulk(actions=self.serialize_actions(
+                documents=actions, index_name=index_name)):
+            operation, result = next(iter(item.items()))
+            if ok:
+                succeeded.append(result.get('_id'))
+                continue
+            failures.append({'id': result.get('_id'),
+                             'status': result.get('status'),
+                             'error': result.get('error')})
+            logger.error('Document %s not indexed (%s, status %s): %s',
+                         result.get('_id'), operation, result.get('status'),
+                         result.get('error'))
+        ES_DOCUMENTS.labels('success').inc(len(succeeded))
+        ES_DOCUMENTS.labels('failed').inc(len(failures))
+        logger.info('Transfer data: success: %s, failed: %s', len(succeeded),
+                    len(failures))
+        return succeeded, failures
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def get_ids(self, index_name: str) -> list[str]:
+        """ID всех документов индекса"""
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            return [hit['_id'] for hit in helpers.scan(
+                self.client, index=index_name,
+                query={'query': {'match_all': {}}, '_source': False},
+                size=1000)]
+
+    def delete_data(self, ids: Iterable[str],
+                    index_name: Optional[str] = None) -> int:
+        """
+        Удаляет документы по ID пакетами _bulk. Отсутствующие документы
+        считаются удаленными. Возвращает количество удаленных документов
+        """
+        encode = self.encoder.encode
+        prefix = (f'{{"delete":{{"_index":'
+                  f'{encode(index_name or self.index_name)},"_id":')
+        deleted = 0
+        for ok, item in self.bulk(actions=(
+                f'{prefix}{encode(document_id)}}}}}'.encode()
+                for document_id in ids)):
+            operation, result = next(iter(item.items()))
+            if ok or result.get('status') == 404:
+                deleted += 1
+                continue
+            logger.error('Document %s not deleted (status %s): %s',
+                         result.get('_id'), result.get('status'),
+                         result.get('error'))
+        logger.info('Delete data: deleted: %d', deleted)
+        return deleted
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def get_range_checksums(self, prefixes: list[str]
+                            ) -> dict[str, tuple[int, int]]:
+        """
+        Количество документов и сумма их контрольных сумм по диапазонам
+        ID с префиксами prefixes, одним запросом с агрегацией filters.
+        Документы без контрольной суммы учитываются в ней как 0
+        """
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            response = self.client.search(
+                index=self.index_name,
+                body={
+                    'size': 0,
+                    'aggs': {'ranges': {
+                        'filters': {'filters': {
+                            prefix: {'prefix': {'id': prefix}}
+                            for prefix in prefixes}},
+                        'aggs': {'checksum': {
+                            'sum': {'field': 'checksum'}}},
+                    }},
+                },
+            )
+        buckets = response['aggregations']['ranges']['buckets']
+        return {prefix: (bucket['doc_count'],
+                         int(bucket['checksum']['value']))
+                for prefix, bucket in buckets.items()}
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def get_range_documents(self, prefix: str) -> dict[str, Optional[int]]:
+        """Контрольные суммы документов диапазона ID с префиксом prefix"""
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            return {
+                hit['_id']: hit['_source'].get('checksum')
+                for hit in helpers.scan(
+                    self.client, index=self.index_name,
+                    query={'query': {'prefix': {'id': prefix}},
+                           '_source': ['checksum']},
+                    size=1000)
+            }
+
+    def matching_ids(self, query: dict) -> list[str]:
+        """
+        ID документов рабочего индекса, подходящих под запрос. Индекс
+        предварительно обновляется (refresh), чтобы запрос видел только
+        что загруженные документы
+        """
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            self.client.indices.refresh(index=self.index_name)
+            return [hit['_id'] for hit in helpers.scan(
+                self.client, index=self.index_name,
+                query={'query': query, '_source': False}, size=1000)]
+
+    def update_by_query(self, query: dict, script: dict) -> bool:
+        """
+        Обновляет документы по запросу скриптом. Возвращает False, если
+        часть документов пропущена из-за конфликтов версий или ошибок:
+        их уже не исправить обновлением, только полной пересборкой
+        """
+        response = self.client.update_by_query(
+            index=self.index_name,
+            body={'query': query, 'script': script},
+            conflicts='proceed',
+            refresh=True,
         )
-        logger.info('Transfer data: success: %s, failed: %s', success, failed)
+        failures = response.get('failures') or []
+        conflicts = response.get('version_conflicts', 0)
+        if failures or conflicts:
+            logger.warning('Update by query incomplete: %d failures, '
+                           '%d version conflicts', len(failures), conflicts)
+            return False
+        return True
+
+    @staticmethod
+    def persons_query(ids: list[str]) -> dict:
+        """Фильмы, где персонажи участвуют как актеры или сценаристы"""
+        return {'bool': {'should': [
+            {'nested': {'path': role, 'query': {
+                'terms': {f'{role}.id': list(ids)}}}}
+            for role in PERSON_ROLES
+        ]}}
+
+    @staticmethod
+    def genres_query(names: list[str]) -> dict:
+        """Фильмы с жанрами names"""
+        return {'terms': {'genre': list(names)}}
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def rename_persons(self, names: dict[str, str]
+                       ) -> tuple[list[str], bool]:
+        """
+        Частично обновляет фильмы, в которых персонажи участвуют как
+        актеры или сценаристы: новые имена применяются скриптом на стороне
+        Elasticsearch без пересборки документов. Возвращает ID измененных
+        фильмов и признак того, что обновлены все
+        """
+        query = self.persons_query(ids=list(names))
+        ids = self.matching_ids(query=query)
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            complete = not ids or self.update_by_query(
+                query=query,
+                script={'source': RENAME_PERSONS_SCRIPT,
+                        'lang': 'painless',
+                        'params': {'names': names, 'roles': PERSON_ROLES}})
+        logger.info('Persons renamed: %d, documents: %d', len(names),
+                    len(ids))
+        return ids, complete
+
+    @backoff(exception=CONNECTION_ERRORS)
+    def rename_genres(self, renames: dict[str, str]
+                      ) -> tuple[list[str], bool]:
+        """
+        Заменяет прежние названия жанров новыми во всех фильмах.
+        Возвращает ID измененных фильмов и признак того, что обновлены все
+        """
+        query = self.genres_query(names=list(renames))
+        ids = self.matching_ids(query=query)
+        with es_breaker.guard(TransportError, is_failure=is_unavailable):
+            complete = not ids or self.update_by_query(
+                query=query,
+                script={'source': RENAME_GENRES_SCRIPT,
+                        'lang': 'painless',
+                        'params': {'renames': renames}})
+        logger.info('Genres renamed: %d, documents: %d', len(renames),
+                    len(ids))
+        return ids, complete
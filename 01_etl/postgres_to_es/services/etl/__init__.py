@@ -1,2 +1,4 @@
 from .state import *
 from .backoff import *
+from .breaker import *
+from .transform import *
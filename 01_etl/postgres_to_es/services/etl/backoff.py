@@ -1,28 +1,42 @@
 import logging
+import random
 from functools import wraps
 from time import sleep
 
+from services.etl.metrics import BACKOFF_RETRIES
+
 logger = logging.getLogger(__name__)
 
 
+def decorrelated_jitter(previous: float, base: float, cap: float,
+                        factor: float = 3) -> float:
+    """
+    Пауза перед следующей попыткой по схеме decorrelated jitter:
+    случайное значение от base до previous * factor, не больше cap.
+    Процессы, упавшие одновременно, повторяют запросы вразнобой
+    """
+    return min(cap, random.uniform(base, max(previous, base) * factor))
+
+
 def backoff(
     exception: list,
     start_sleep_time=0.1,
-    factor=2,
+    factor=3,
     border_sleep_time=30,
     max_attempts=2
 ):
     """
     Функция для повторного выполнения функции через некоторое время,
-    если возникла ошибка. Использует наивный экспоненциальный рост времени
-    повтора (factor) до граничного времени ожидания (border_sleep_time)
+    если возникла ошибка. Время повтора растет экспоненциально со
+    случайным разбросом (decorrelated jitter) до граничного времени
+    ожидания (border_sleep_time)
 
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
-        t = border_sleep_time if t >= border_sleep_time
-    :param exception: исключение, которое отлавливается
+        t = min(border_sleep_time, random(start_sleep_time, t * factor))
+    :param exception: исключение (или кортеж исключений), которое
+        отлавливается
     :param start_sleep_time: начальное время повтора
-    :param factor: во сколько раз нужно увеличить время ожидания
+    :param factor: во сколько раз может вырасти время ожидания
     :param border_sleep_time: граничное время ожидания
     :param max_attempts: максимальное количество попыток подключения
     :return: результат выполнения функции
@@ -35,8 +49,7 @@ def backoff(
             while True:
                 try:
                     attempt += 1
-                    logger.info('Attempt %d out of %d - delay %s',
-                                attempt, max_attempts, time_out)
+                    logger.info('Attempt %d out of %d', attempt, max_attempts)
                     connection = func(*args, **kwargs)
                     return connection
                 except exception as error:
@@ -46,13 +59,13 @@ def backoff(
                     if attempt == max_attempts:
                         raise error
 
-                    if time_out >= border_sleep_time:
-                        time_out = border_sleep_time
-                    else:
-                        time_out += start_sleep_time * 2 ** factor
-
+                    time_out = decorrelated_jitter(previous=time_out,
+                                                   base=start_sleep_time,
+                                                   cap=border_sleep_time,
+                                                   factor=factor)
                     logger.warning(
-                        'Wait for %s seconds and try again', time_out)
+                        'Wait for %.2f seconds and try again', time_out)
+                    BACKOFF_RETRIES.labels(func.__qualname__).inc()
                     sleep(time_out)
 
         return inner
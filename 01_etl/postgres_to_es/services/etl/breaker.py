@@ -0,0 +1,98 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from typing import Callable, Optional
+
+from services.etl.metrics import CIRCUIT_STATE
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['CircuitBreaker', 'CircuitOpenError']
+
+STATES = {'closed': 0, 'half-open': 1, 'open': 2}
+
+
+class CircuitOpenError(Exception):
+    """Сервис признан недоступным, запрос не отправлялся"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для внешнего сервиса. После failure_threshold
+    ошибок подряд запросы отклоняются сразу (CircuitOpenError), не
+    нагружая сервис. Через reset_timeout пропускается один пробный
+    запрос: успех замыкает цепь, ошибка снова размыкает ее
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        CIRCUIT_STATE.labels(name).set(STATES[self.state])
+
+    def set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning("Circuit '%s': %s -> %s", self.name, self.state,
+                           state)
+            self.state = state
+            CIRCUIT_STATE.labels(self.name).set(STATES[state])
+
+    def before_call(self) -> None:
+        """Пропускает запрос или сразу отклоняет его при разомкнутой цепи"""
+        with self.lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + self.reset_timeout - monotonic()
+            if self.state == 'open' and retry_after <= 0:
+                self.set_state('half-open')
+                return
+            raise CircuitOpenError(name=self.name,
+                                   retry_after=max(retry_after, 0.0)
+                                   or self.reset_timeout)
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.set_state('closed')
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if (self.state == 'half-open'
+                    or self.failures >= self.failure_threshold):
+                self.opened_at = monotonic()
+                self.set_state('open')
+
+    @contextmanager
+    def guard(self, exceptions,
+              is_failure: Optional[Callable[[BaseException], bool]] = None):
+        """
+        Выполняет запрос под защитой размыкателя. Ошибкой сервиса
+        считаются исключения exceptions (и только те, для которых
+        is_failure вернет True). Прочие исключения означают, что сервис
+        ответил, и цепь не размыкают
+        """
+        self.before_call()
+        try:
+            yield
+        except exceptions as error:
+            if is_failure is None or is_failure(error):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            self.record_success()
+            raise
+        self.record_success()
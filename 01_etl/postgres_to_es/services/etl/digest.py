@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from itertools import islice
+from typing import Iterable, Iterator
+
+from services.etl.metrics import DIGEST_DOCUMENTS
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['DigestStore']
+
+
+class DigestStore:
+    """
+    Постоянное хранилище хешей документов, загруженных в Elasticsearch.
+    Документ, хеш которого совпадает с сохраненным, повторно не
+    отправляется. Хеши сохраняются только после подтверждения загрузки
+    """
+    lookup_size = 500
+
+    def __init__(self, file_path: str, file_name: str):
+        self.file_state = os.path.join(file_path, file_name)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.file_state, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS digest '
+                          '(id TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+        self.conn.commit()
+        self.skipped = 0
+        self.passed = 0
+
+    @staticmethod
+    def digest(document: dict) -> str:
+        """Хеш содержимого документа, не зависящий от порядка ключей"""
+        payload = json.dumps(document, sort_keys=True, ensure_ascii=False,
+                             default=str)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def lookup(self, ids: list[str]) -> dict[str, str]:
+        """Возвращает сохраненные хеши документов"""
+        placeholders = ', '.join('?' * len(ids))
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT id, digest FROM digest WHERE id IN ({placeholders})',
+                ids).fetchall()
+        return dict(rows)
+
+    def skip_unchanged(self, documents: Iterable[dict],
+                       pending: dict[str, str]) -> Iterator[dict]:
+        """
+        Пропускает дальше только измененные документы. Хеши пропущенных
+        документов добавляются в pending и сохраняются методом save
+        после успешной загрузки
+        """
+        documents = iter(documents)
+        skipped = 0
+        while chunk := list(islice(documents, self.lookup_size)):
+            digests = {document['id']: self.digest(document)
+                       for document in chunk}
+            stored = self.lookup(ids=list(digests))
+            for document in chunk:
+                digest = digests[document['id']]
+                if stored.get(document['id']) == digest:
+                    skipped += 1
+                    continue
+                pending[document['id']] = digest
+                self.passed += 1
+                DIGEST_DOCUMENTS.labels('passed').inc()
+                yield document
+        self.skipped += skipped
+        DIGEST_DOCUMENTS.labels('skipped').inc(skipped)
+        if skipped:
+            logger.info('Skipped %d unchanged documents', skipped)
+
+    def save(self, pending: dict[str, str]) -> None:
+        """Сохраняет хеши загруженных документов"""
+        if not pending:
+            return
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO digest (id, digest) VALUES (?, ?)',
+                    pending.items())
+        pending.clear()
+
+    def invalidate(self, ids: Iterable[str]) -> None:
+        """Забывает хеши документов, измененных в обход полной сборки"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM digest WHERE id = ?',
+                                      ((document_id,) for document_id in ids))
+
+    def clear(self) -> None:
+        """Удаляет все хеши, например перед полной переиндексацией"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM digest')
+        logger.info('Digest store cleared')
+
+    def close(self) -> None:
+        self.conn.close()
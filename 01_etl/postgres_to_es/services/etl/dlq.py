@@ -0,0 +1,151 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from services.etl.metrics import DLQ_DOCUMENTS
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['DeadLetterQueue']
+
+
+class DeadLetterQueue:
+    """
+    Журнал документов, отклоненных Elasticsearch. Записи только
+    добавляются в сегменты NDJSON (ID документа, индекс, статус и причина
+    ошибки). Сегмент закрывается при достижении segment_bytes, хранится
+    не больше max_segments сегментов. Журнал общий для процессов одного
+    хоста: каждая запись и забор сегментов на повторную загрузку
+    выполняются под блокировкой каталога (flock), файл сегмента
+    открывается только на время записи. Повторная загрузка
+    переименовывает сегменты и удаляет их после обработки
+    """
+    prefix = 'segment-'
+    claimed_prefix = 'claimed-'
+    suffix = '.ndjson'
+    lock_name = '.lock'
+
+    def __init__(self, file_path: str, dir_name: str,
+                 segment_bytes: int = 8 * 1024 * 1024,
+                 max_segments: int = 100):
+        self.path = os.path.join(file_path, dir_name)
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """Блокировка журнала для потоков процесса и других процессов"""
+        with self.lock:
+            with open(os.path.join(self.path, self.lock_name), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def segments(self, prefix: Optional[str] = None) -> list[str]:
+        """Пути сегментов от старых к новым"""
+        prefix = prefix or self.prefix
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.startswith(prefix) and name.endswith(self.suffix))
+
+    def next_segment(self) -> str:
+        """
+        Новый сегмент. Номера продолжают и забранные сегменты, чтобы
+        переименование не перезаписало неповторенный сегмент
+        """
+        seq = 0
+        for prefix in (self.prefix, self.claimed_prefix):
+            if segments := self.segments(prefix=prefix):
+                name = os.path.basename(segments[-1])
+                seq = max(seq, int(name[len(prefix):-len(self.suffix)]) + 1)
+        return os.path.join(self.path, f'{self.prefix}{seq:08d}{self.suffix}')
+
+    def current_segment(self) -> str:
+        """Последний сегмент или новый, если последний заполнен"""
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+            return segments[-1]
+        return self.next_segment()
+
+    def rotate(self) -> None:
+        """Удаляет самые старые сегменты сверх лимита"""
+        segments = self.segments()
+        for path in segments[:max(len(segments) - self.max_segments, 0)]:
+            logger.warning("Dead letter segment '%s' dropped by retention",
+                           path)
+            os.remove(path)
+
+    def append(self, failures: Iterable[dict],
+               index_name: Optional[str] = None) -> int:
+        """Записывает отклоненные документы. Возвращает число записей"""
+        failed_at = f'{datetime.now(timezone.utc)}'
+        lines = [json.dumps({**failure, 'index': index_name,
+                             'failed_at': failed_at},
+                            ensure_ascii=False, default=str) + '\n'
+                 for failure in failures]
+        if not lines:
+            return 0
+        with self.locked():
+            with open(self.current_segment(), 'a',
+                      encoding='utf-8') as segment:
+                segment.writelines(lines)
+                segment.flush()
+                os.fsync(segment.fileno())
+            self.rotate()
+        DLQ_DOCUMENTS.labels('written').inc(len(lines))
+        logger.warning('%d documents written to dead letter queue',
+                       len(lines))
+        return len(lines)
+
+    def seal(self) -> list[str]:
+        """
+        Забирает все сегменты на повторную загрузку: переименовывает их,
+        поэтому новые отказы любого процесса пишутся уже в новый сегмент.
+        Возвращает также сегменты, забранные прерванной загрузкой
+        """
+        with self.locked():
+            for path in self.segments():
+                name = os.path.basename(path)[len(self.prefix):]
+                os.rename(path, os.path.join(
+                    self.path, f'{self.claimed_prefix}{name}'))
+            return self.segments(prefix=self.claimed_prefix)
+
+    @staticmethod
+    def read_ids(segments: Iterable[str]) -> dict[str, list[str]]:
+        """
+        Уникальные ID документов сегментов по индексам в порядке первого
+        отказа. Записи без индекса относятся к индексу фильмов ('')
+        """
+        ids: dict[str, dict[str, None]] = {}
+        for path in segments:
+            with open(path, encoding='utf-8') as segment:
+                for line in segment:
+                    try:
+                        entry = json.loads(line)
+                        ids.setdefault(entry.get('index') or '',
+                                       {})[entry['id']] = None
+                    except (ValueError, KeyError):
+                        logger.warning("Broken dead letter in '%s'", path)
+        return {index_name: list(index_ids)
+                for index_name, index_ids in ids.items()}
+
+    def remove(self, segments: Iterable[str]) -> None:
+        """Удаляет обработанные сегменты"""
+        for path in segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                logger.warning("Dead letter segment '%s' already removed",
+                               path)
+
+    def close(self) -> None:
+        """Файлы сегментов открываются только на время записи"""
@@ -0,0 +1,68 @@
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from services.pg import models, queries
+
+__all__ = ['INDEXES', 'IndexDefinition', 'enabled_indexes']
+
+schema_path: Path = Path(__file__).resolve().parents[2] / 'config'
+
+
+class IndexDefinition(NamedTuple):
+    """
+    Декларативное описание дополнительного индекса Elasticsearch.
+    Документы по ID собирает запрос query, весь индекс - запрос stream,
+    строки приводятся к документам функцией transform. Запрос existing
+    отбирает ID записей, которые еще есть в PostgreSQL: документы
+    удаленных записей удаляются из индекса.
+    sources связывает источники изменений общего прохода извлечения
+    (person, genre, filmwork) с ID документов индекса: None - ID
+    измененных записей и есть ID документов, запрос - разворачивает
+    их в ID документов
+    """
+    name: str
+    schema: str
+    query: queries.Query
+    existing: queries.Query
+    stream: str
+    transform: Callable[[Iterable[dict]], Iterator[dict]]
+    sources: dict[str, Optional[queries.Query]]
+
+
+INDEXES: dict[str, IndexDefinition] = {
+    definition.name: definition for definition in (
+        IndexDefinition(
+            name='genres',
+            schema=f'{schema_path / "es_genres_schema.json"}',
+            query=queries.GENRE_DOCUMENTS_BY_ID,
+            existing=queries.EXISTING_GENRES,
+            stream=queries.genre_documents(),
+            transform=partial(models.validate_documents,
+                              model=models.ESGenreDocumentModel),
+            sources={'genre': None},
+        ),
+        IndexDefinition(
+            name='persons',
+            schema=f'{schema_path / "es_persons_schema.json"}',
+            query=queries.PERSON_DOCUMENTS_BY_ID,
+            existing=queries.EXISTING_PERSONS,
+            stream=queries.person_documents(),
+            transform=partial(models.validate_documents,
+                              model=models.ESPersonDocumentModel),
+            sources={'person': None,
+                     'filmwork': queries.PERSONS_BY_FILMWORK},
+        ),
+    )
+}
+
+
+def enabled_indexes(names: str) -> list[IndexDefinition]:
+    """Описания индексов из списка имен через запятую (ES_INDEXES)"""
+    definitions = []
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        if name not in INDEXES:
+            raise ValueError(f"Unknown index '{name}', "
+                             f"expected one of: {', '.join(INDEXES)}")
+        definitions.append(INDEXES[name])
+    return definitions
@@ -0,0 +1,169 @@
+import json
+import logging
+import math
+import threading
+import zlib
+from typing import Callable, Optional
+
+from services.etl.state import BaseStorage
+from services.pg import PostgresService, queries
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Heartbeat', 'LeaseLost', 'LeaseManager', 'PostgresStorage',
+           'shard_of']
+
+
+def shard_of(filmwork_id: str, shards: int) -> int:
+    """
+    Номер шарда фильма. Используется crc32, а не hash(), чтобы
+    разбиение совпадало во всех процессах и на всех хостах
+    """
+    return zlib.crc32(filmwork_id.encode()) % shards
+
+
+class LeaseLost(Exception):
+    """Аренда шарда истекла и перехвачена другим процессом"""
+
+
+class Heartbeat:
+    """
+    Фоновый поток, который вызывает beat каждые interval секунд, пока
+    не будет остановлен. Держит блокировку процесса живой во время
+    долгих операций (переключение индекса, сверка) и ожидания изменений,
+    которые не проходят через heartbeat ETL
+    """
+
+    def __init__(self, beat: Callable[[], None], interval: float):
+        self.beat = beat
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='heartbeat',
+                                       daemon=True)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                logger.exception('Heartbeat failed')
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Общее хранилище состояния в PostgreSQL (таблица etl.state).
+    Состояние шарда доступно любому процессу, который перехватит его
+    аренду, поэтому обработка продолжается с последнего курсора.
+    С fence (шард, владелец) состояние записывается тем же запросом,
+    который проверяет аренду: после ее потери запись отклоняется
+    (LeaseLost)
+    """
+
+    def __init__(self, pg_client: PostgresService, name: str,
+                 fence: Optional[tuple[int, str]] = None):
+        self.pg_client = pg_client
+        self.name = name
+        self.fence = fence
+        self.lock = threading.Lock()
+
+    def save_state(self, state: dict) -> None:
+        """Сохранить состояние в постоянное хранилище"""
+        value = json.dumps(state, ensure_ascii=False)
+        with self.lock:
+            if self.fence is None:
+                self.pg_client.executor(
+                    query=queries.SAVE_SHARED_STATE.bind(self.name, value),
+                    fetch=False)
+                return
+            shard, owner = self.fence
+            if not self.pg_client.executor(
+                    query=queries.SAVE_FENCED_STATE.bind(
+                        self.name, value, shard, owner)):
+                raise LeaseLost(f'Lease of shard {shard} lost by {owner}, '
+                                f'state not saved')
+
+    def retrieve_state(self) -> Optional[dict]:
+        """Загрузить состояние из постоянного хранилища"""
+        with self.lock:
+            rows = self.pg_client.executor(
+                query=queries.LOAD_SHARED_STATE.bind(self.name))
+        return rows[0]['value'] if rows else None
+
+
+class LeaseManager:
+    """
+    Распределяет шарды между процессами ETL через аренды с ограниченным
+    сроком действия в PostgreSQL. Каждый процесс держит не больше
+    справедливой доли шардов, продлевает свои аренды и забирает шарды,
+    аренда которых истекла (процесс упал или завис)
+    """
+
+    def __init__(self, pg_client: PostgresService, shards: int, owner: str,
+                 ttl: float):
+        self.pg_client = pg_client
+        self.shards = shards
+        self.owner = owner
+        self.ttl = ttl
+        self.owned: list[int] = []
+
+    def setup(self) -> None:
+        """Создает таблицы аренд и общего состояния"""
+        self.pg_client.executor(query=queries.SHARED_STATE_SCHEMA,
+                                fetch=False)
+
+    def acquire(self, shard: int) -> bool:
+        """Берет свободный или просроченный шард либо продлевает свой"""
+        return bool(self.pg_client.executor(
+            query=queries.ACQUIRE_LEASE.bind(shard, self.owner, self.ttl)))
+
+    def renew(self, shard: int) -> None:
+        """Продлевает аренду шарда или сообщает о ее потере"""
+        if not self.acquire(shard):
+            if shard in self.owned:
+                self.owned.remove(shard)
+            raise LeaseLost(f'Lease of shard {shard} lost by {self.owner}')
+
+    def release(self, shards: list[int]) -> None:
+        """Досрочно освобождает аренды шардов"""
+        if shards:
+            self.pg_client.executor(
+                query=queries.RELEASE_LEASES.bind(list(shards), self.owner))
+            logger.info('Shards released: %s', shards)
+        self.owned = [shard for shard in self.owned if shard not in shards]
+
+    def rebalance(self) -> list[int]:
+        """
+        Приводит число своих шардов к справедливой доле
+        ceil(shards / живые процессы): лишние освобождает, недостающие
+        забирает из свободных. Возвращает список своих шардов
+        """
+        leases = {row['shard']: row['owner'] for row in
+                  self.pg_client.executor(query=queries.LIVE_LEASES)}
+        owners = set(leases.values()) | {self.owner}
+        fair_share = math.ceil(self.shards / len(owners))
+
+        mine = sorted(shard for shard, owner in leases.items()
+                      if owner == self.owner)
+        self.owned = mine
+        if len(mine) > fair_share:
+            self.release(mine[fair_share:])
+
+        self.owned = [shard for shard in self.owned if self.acquire(shard)]
+        for shard in range(self.shards):
+            if len(self.owned) >= fair_share:
+                break
+            if shard not in leases and self.acquire(shard):
+                logger.info('Shard %d acquired by %s', shard, self.owner)
+                self.owned.append(shard)
+        return list(self.owned)
+
+    def release_all(self) -> None:
+        self.release(list(self.owned))
@@ -0,0 +1,134 @@
+import logging
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Iterable, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['BACKOFF_RETRIES', 'BATCH_DOCUMENTS', 'CIRCUIT_STATE',
+           'DIGEST_DOCUMENTS', 'DIMENSION_CACHE', 'DLQ_DOCUMENTS',
+           'ES_BULK_CHUNK_SIZE', 'ES_BULK_SECONDS', 'ES_DOCUMENTS',
+           'PG_QUERY_SECONDS', 'PG_ROWS', 'RECONCILE_DOCUMENTS',
+           'RECONCILE_RANGES', 'REPLICATION_LAG', 'STAGE_DOCUMENTS',
+           'STAGE_SECONDS', 'WATERMARK', 'observe_watermarks',
+           'start_metrics_server', 'timed']
+
+BATCH_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_duration_seconds',
+    'Time spent in an ETL stage per batch', ['stage'])
+STAGE_DOCUMENTS = Counter(
+    'etl_documents_total',
+    'Documents passed through an ETL stage', ['stage'])
+BATCH_DOCUMENTS = Histogram(
+    'etl_batch_documents',
+    'Documents per batch of an ETL stage', ['stage'],
+    buckets=BATCH_BUCKETS)
+PG_QUERY_SECONDS = Histogram(
+    'etl_pg_query_duration_seconds',
+    'PostgreSQL query round trip time', ['query'])
+PG_ROWS = Counter(
+    'etl_pg_rows_total',
+    'Rows fetched from PostgreSQL', ['query'])
+ES_BULK_SECONDS = Histogram(
+    'etl_es_bulk_duration_seconds',
+    'Elasticsearch bulk request time')
+ES_BULK_CHUNK_SIZE = Gauge(
+    'etl_es_bulk_chunk_size',
+    'Current adaptive bulk chunk size in documents')
+ES_DOCUMENTS = Counter(
+    'etl_es_documents_total',
+    'Documents sent to Elasticsearch by result', ['result'])
+DIGEST_DOCUMENTS = Counter(
+    'etl_digest_documents_total',
+    'Documents checked against stored digests by result', ['result'])
+DLQ_DOCUMENTS = Counter(
+    'etl_dlq_documents_total',
+    'Documents written to or replayed from the dead letter queue',
+    ['result'])
+DIMENSION_CACHE = Counter(
+    'etl_dimension_cache_total',
+    'Dimension cache lookups by result', ['cache', 'result'])
+BACKOFF_RETRIES = Counter(
+    'etl_backoff_retries_total',
+    'Retries made by the backoff decorator', ['function'])
+RECONCILE_RANGES = Counter(
+    'etl_reconcile_ranges_total',
+    'ID ranges compared by the reconciler by result', ['result'])
+RECONCILE_DOCUMENTS = Counter(
+    'etl_reconcile_documents_total',
+    'Drifted documents repaired by the reconciler', ['result'])
+CIRCUIT_STATE = Gauge(
+    'etl_circuit_state',
+    'Circuit breaker state: 0 closed, 1 half-open, 2 open', ['service'])
+WATERMARK = Gauge(
+    'etl_watermark_timestamp_seconds',
+    'Modification time of the last processed record', ['source'])
+REPLICATION_LAG = Gauge(
+    'etl_replication_lag_seconds',
+    'Now minus watermark while a source has pending changes', ['source'])
+
+
+def timed(iterable: Iterable, stage: str) -> Iterator:
+    """
+    Пропускает элементы ленивой стадии и учитывает только время,
+    проведенное внутри нее, а не у потребителя. Время и количество
+    элементов фиксируются после исчерпания итератора
+    """
+    iterator = iter(iterable)
+    elapsed, count = 0.0, 0
+    while True:
+        started = perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += perf_counter() - started
+        count += 1
+        yield item
+    STAGE_SECONDS.labels(stage).observe(elapsed)
+    STAGE_DOCUMENTS.labels(stage).inc(count)
+    BATCH_DOCUMENTS.labels(stage).observe(count)
+
+
+def observe_watermarks(states: dict, caught_up: bool) -> None:
+    """
+    Обновляет водяные знаки источников по курсорам состояния.
+    Отставание считается только пока изменения не выбраны до конца:
+    в простое время последнего изменения не означает задержку
+    """
+    now = datetime.now(timezone.utc)
+    for source in ('person', 'genre', 'filmwork'):
+        modified = states.get(source)
+        if isinstance(modified, dict):
+            modified = modified.get('modified')
+        if not modified:
+            continue
+        try:
+            watermark = datetime.fromisoformat(modified)
+        except ValueError:
+            continue
+        if watermark.tzinfo is None:
+            watermark = watermark.replace(tzinfo=timezone.utc)
+        WATERMARK.labels(source).set(watermark.timestamp())
+        lag = 0 if caught_up else (now - watermark).total_seconds()
+        REPLICATION_LAG.labels(source).set(max(lag, 0))
+
+
+def start_metrics_server(port: int, addr: str = '0.0.0.0') -> bool:
+    """
+    Запускает HTTP-сервер метрик в формате Prometheus. Занятый порт
+    (например, вторым процессом на том же хосте) не мешает работе ETL
+    """
+    try:
+        start_http_server(port=port, addr=addr)
+    except OSError as error:
+        logger.warning('Metrics endpoint not started on %s:%d: %s', addr,
+                       port, error)
+        return False
+    logger.info('Metrics endpoint started on %s:%d', addr, port)
+    return True
@@ -0,0 +1,84 @@
+import logging
+import os
+import sqlite3
+import threading
+from itertools import islice
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['NameStore']
+
+
+class NameStore:
+    """
+    Постоянное хранилище известных имен персонажей и названий жанров.
+    По нему изменение записи отличается от переименования, которое
+    применяется частичным обновлением документов. Имена хранятся в SQLite
+    отдельно от курсоров, по областям (scope): у каждого шарда своя
+    область, поэтому переименование видит каждый шард. Пустая область
+    заполняется текущими именами из PostgreSQL
+    """
+    seed_size = 5000
+
+    def __init__(self, file_path: str, file_name: str):
+        self.file_state = os.path.join(file_path, file_name)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.file_state, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS name '
+                          '(kind TEXT NOT NULL, scope TEXT NOT NULL, '
+                          'id TEXT NOT NULL, name TEXT, '
+                          'PRIMARY KEY (kind, scope, id))')
+        self.conn.commit()
+
+    def lookup(self, kind: str, scope: str,
+               ids: list[str]) -> dict[str, str]:
+        """Возвращает известные имена записей"""
+        placeholders = ', '.join('?' * len(ids))
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT id, name FROM name WHERE kind = ? AND scope = ? '
+                f'AND id IN ({placeholders})', [kind, scope, *ids]).fetchall()
+        return dict(rows)
+
+    def save(self, kind: str, scope: str, names: dict[str, str]) -> None:
+        """Запоминает текущие имена записей"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO name (kind, scope, id, name) '
+                    'VALUES (?, ?, ?, ?)',
+                    ((kind, scope, record_id, name)
+                     for record_id, name in names.items()))
+
+    def is_empty(self, kind: str, scope: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM name WHERE kind = ? AND scope = ? LIMIT 1',
+                (kind, scope)).fetchone()
+        return row is None
+
+    def seed(self, kind: str, scope: str, rows: Iterable) -> None:
+        """
+        Заменяет имена области строками (id, name) выборки, например
+        после полной переиндексации
+        """
+        rows = iter(rows)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'DELETE FROM name WHERE kind = ? AND scope = ?',
+                    (kind, scope))
+                count = 0
+                while chunk := list(islice(rows, self.seed_size)):
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO name (kind, scope, id, name) '
+                        'VALUES (?, ?, ?, ?)',
+                        ((kind, scope, row['id'], row['name'])
+                         for row in chunk))
+                    count += len(chunk)
+        logger.info("Name store seeded: %d %s names for scope '%s'", count,
+                    kind, scope)
+
+    def close(self) -> None:
+        self.conn.close()
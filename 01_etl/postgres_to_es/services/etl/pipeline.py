@@ -0,0 +1,179 @@
+import copy
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from config.settings import etl_settings
+from services.etl.metrics import observe_watermarks
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class Batch:
+    """Пакет изменений, проходящий через стадии конвейера"""
+    seq: int
+    states: dict
+    data: Any = None
+    documents: Optional[list] = None
+    digests: dict = field(default_factory=dict)
+    updates: dict = field(default_factory=dict)
+    changes: dict = field(default_factory=dict)
+    caught_up: bool = False
+
+
+class AckTracker:
+    """
+    Фиксирует состояние только для непрерывной последовательности
+    подтвержденных Elasticsearch пакетов: пакет N сохраняется не раньше,
+    чем подтверждены все пакеты до него
+    """
+
+    def __init__(self, on_commit: Callable[[Batch], None]):
+        self.on_commit = on_commit
+        self.next_seq = 0
+        self.acked: dict[int, Batch] = {}
+        self.lock = threading.Lock()
+
+    def ack(self, batch: Batch) -> None:
+        with self.lock:
+            self.acked[batch.seq] = batch
+            while self.next_seq in self.acked:
+                self.on_commit(self.acked.pop(self.next_seq))
+                self.next_seq += 1
+
+
+class Pipeline:
+    """
+    Конвейер ETL: извлечение, трансформация и загрузка выполняются
+    в отдельных потоках и связаны ограниченными очередями. Следующий пакет
+    извлекается из PostgreSQL, пока предыдущий загружается в Elasticsearch,
+    а заполненная очередь притормаживает более быструю стадию
+    """
+
+    def __init__(self, etl,
+                 queue_size: int = etl_settings.PIPELINE_QUEUE_SIZE):
+        self.etl = etl
+        self.transform_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.load_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.tracker = AckTracker(on_commit=self.commit)
+        self.stop = threading.Event()
+        self.errors: list[BaseException] = []
+        self.loaded = 0
+
+    def run(self) -> int:
+        """
+        Обрабатывает все накопленные изменения и дожидается подтверждения
+        последнего пакета. Возвращает количество загруженных документов
+        """
+        threads = [
+            threading.Thread(target=self.stage, args=(name, target),
+                             name=f'etl-{name}', daemon=True)
+            for name, target in (('extract', self.extract),
+                                 ('transform', self.transform),
+                                 ('load', self.load))
+        ]
+        """
+        Запросы стадии загрузки (пересборка фильмов, дополнительные
+        индексы) идут через отдельное соединение пула: соединение
+        psycopg2 и его подготовленные операторы не делятся между потоками
+        """
+        self.etl.load_pg_client = self.etl.runtime.postgres()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.etl.load_pg_client.close()
+            self.etl.load_pg_client = self.etl.pg_client
+
+        if self.errors:
+            raise self.errors[0]
+        return self.loaded
+
+    def stage(self, name: str, target: Callable[[], None]) -> None:
+        """
+        Запускает стадию и останавливает весь конвейер при ошибке.
+        Во время профилирования поток стадии профилируется отдельно
+        """
+        profiler = self.etl.profiler
+        try:
+            with profiler.thread(), profiler.stage(name):
+                target()
+        except BaseException as error:
+            logger.exception('Pipeline stage failed: %s', error)
+            self.errors.append(error)
+            self.stop.set()
+
+    def put(self, stage_queue: queue.Queue, item: Any) -> bool:
+        while not self.stop.is_set():
+            try:
+                stage_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, stage_queue: queue.Queue) -> Any:
+        while not self.stop.is_set():
+            try:
+                return stage_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def extract(self) -> None:
+        seq = 0
+        try:
+            while not self.stop.is_set():
+                number_data, modified_data = self.etl.extract()
+                logger.info('Extracted %d modified data (batch %d)',
+                            number_data, seq)
+                batch = Batch(seq=seq, states=copy.deepcopy(self.etl.states),
+                              data=modified_data, updates=self.etl.updates,
+                              changes=self.etl.changes,
+                              caught_up=self.etl.caught_up)
+                if not self.put(self.transform_queue, batch):
+                    return
+                seq += 1
+                if self.etl.caught_up:
+                    return
+        finally:
+            self.put(self.transform_queue, _DONE)
+
+    def transform(self) -> None:
+        while (batch := self.get(self.transform_queue)) is not _DONE:
+            if batch.data is not None:
+                batch.documents = list(self.etl.skip_unchanged(
+                    self.etl.transform(modified_data=batch.data),
+                    pending=batch.digests))
+            else:
+                batch.documents = []
+            batch.data = None
+            if not self.put(self.load_queue, batch):
+                return
+        self.put(self.load_queue, _DONE)
+
+    def load(self) -> None:
+        while (batch := self.get(self.load_queue)) is not _DONE:
+            if batch.documents:
+                self.etl.load(transformed_data=batch.documents,
+                              pending=batch.digests)
+                self.loaded += len(batch.documents)
+            self.etl.apply_updates(updates=batch.updates)
+            self.etl.load_indexes(changes=batch.changes)
+            self.tracker.ack(batch)
+
+    def commit(self, batch: Batch) -> None:
+        """Сохраняет состояние, подтвержденное загрузкой пакета"""
+        logger.info('Save state of data modified (batch %d)', batch.seq)
+        self.etl.state.set_state('modified', batch.states)
+        if self.etl.digests is not None:
+            self.etl.digests.save(pending=batch.digests)
+        observe_watermarks(states=batch.states, caught_up=batch.caught_up)
+        self.etl.heartbeat()
@@ -0,0 +1,201 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Profiler', 'log_dir']
+
+MIB = 1024 * 1024
+
+"""Выделения памяти самого профилировщика в отчет не попадают"""
+SNAPSHOT_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__))
+
+
+def log_dir(default: str) -> str:
+    """Каталог файла журнала процесса (logs.log) или default"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.dirname(handler.baseFilename)
+    return default
+
+
+class Profiler:
+    """
+    Профилирование работающего процесса по запросу. Сигнал или
+    управляющий файл (в нем можно указать число циклов) включают cProfile
+    на следующие cycles циклов ETL и снимки tracemalloc вокруг стадий
+    extract, transform и load. Отчет каждого цикла (текст и .prof для
+    pstats) пишется в каталог path. Пока профилирование не запрошено,
+    цикл проверяет только флаг и наличие управляющего файла
+    """
+
+    def __init__(self, path: str, cycles: int = 3,
+                 control_file: Optional[str] = None, top: int = 30,
+                 memory: bool = True):
+        self.path = path
+        self.cycles = cycles
+        self.control_file = (os.path.join(path, control_file)
+                             if control_file else None)
+        self.top = top
+        self.memory = memory
+        self.requested = 0
+        self.remaining = 0
+        self.sequence = 0
+        self.report: Optional[list[tuple]] = None
+        self.stats: Optional[pstats.Stats] = None
+        self.lock = threading.Lock()
+
+    def install(self, signal_name: str) -> None:
+        """Запрашивает профилирование по сигналу signal_name (SIGUSR1)"""
+        signum = getattr(signal, signal_name, None)
+        if signum is None:
+            logger.warning("Signal '%s' is not supported, profiling by "
+                           "signal disabled", signal_name)
+            return
+        try:
+            signal.signal(signum, self.on_signal)
+        except ValueError:
+            logger.warning('Profiling signal can be installed only in the '
+                           'main thread')
+            return
+        logger.info('Profiling is requested by %s', signal_name)
+
+    def on_signal(self, signum, frame) -> None:
+        self.request()
+
+    def request(self, cycles: Optional[int] = None) -> None:
+        """Запрашивает профилирование следующих cycles циклов"""
+        self.requested = cycles or self.cycles
+
+    def poll(self) -> None:
+        """
+        Проверяет управляющий файл и запускает запрошенное
+        профилирование. Файл удаляется после чтения
+        """
+        if self.control_file and os.path.exists(self.control_file):
+            try:
+                with open(self.control_file) as control:
+                    cycles = int(control.read().strip() or 0)
+            except (OSError, ValueError):
+                cycles = 0
+            os.remove(self.control_file)
+            self.request(cycles)
+        if self.requested and not self.remaining:
+            self.remaining, self.requested = self.requested, 0
+            logger.warning('Profiling of next %d cycles started',
+                           self.remaining)
+            if self.memory:
+                tracemalloc.start()
+
+    @contextmanager
+    def cycle(self):
+        """Профилирует цикл ETL, если профилирование запрошено"""
+        self.poll()
+        if not self.remaining:
+            yield
+            return
+        self.sequence += 1
+        self.report, self.stats = [], None
+        started = perf_counter()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add(profile)
+            self.write(elapsed=perf_counter() - started)
+            self.report = self.stats = None
+            self.remaining -= 1
+            if not self.remaining:
+                if self.memory:
+                    tracemalloc.stop()
+                logger.warning('Profiling finished')
+
+    @contextmanager
+    def thread(self):
+        """
+        Профилирует работу отдельного потока (стадии конвейера) в рамках
+        текущего цикла: cProfile учитывает только свой поток
+        """
+        if self.report is None:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add(profile)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Снимки памяти до и после стадии: время, объем и пик выделенной
+        памяти и строки кода с наибольшим приростом. Снимки сравниваются
+        при записи отчета, вне профилируемого цикла. Стадии конвейера
+        выполняются одновременно, поэтому их снимки пересекаются
+        """
+        if self.report is None or not tracemalloc.is_tracing():
+            yield
+            return
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            with self.lock:
+                if self.report is not None:
+                    self.report.append(
+                        (name, elapsed, current, peak, before, after))
+
+    def materialize(self, documents: Iterable) -> Iterable:
+        """
+        Во время профилирования выполняет ленивую стадию целиком, чтобы
+        ее время и память не смешивались со следующей стадией
+        """
+        return list(documents) if self.report is not None else documents
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile, stream=io.StringIO())
+            else:
+                self.stats.add(profile)
+
+    def write(self, elapsed: float) -> None:
+        """Пишет отчет цикла: текст и статистику cProfile для pstats"""
+        path = os.path.join(
+            self.path,
+            f'profile-{datetime.now():%Y%m%d-%H%M%S}-{self.sequence}')
+        sections = [f'Cycle {self.sequence}: {elapsed:.3f} s']
+        if self.stats is not None:
+            self.stats.dump_stats(f'{path}.prof')
+            self.stats.sort_stats('cumulative').print_stats(self.top)
+            sections.append(self.stats.stream.getvalue())
+        for name, elapsed, current, peak, before, after in self.report:
+            lines = [f'== {name}: {elapsed:.3f} s, traced '
+                     f'{current / MIB:.1f} MiB, peak {peak / MIB:.1f} MiB']
+            lines.extend(f'{stat}' for stat in after.filter_traces(
+                SNAPSHOT_FILTERS).compare_to(before.filter_traces(
+                    SNAPSHOT_FILTERS), 'lineno')[:self.top])
+            sections.append('\n'.join(lines))
+        with open(f'{path}.txt', 'w', encoding='utf-8') as report:
+            report.write('\n\n'.join(sections) + '\n')
+        logger.warning("Profile report written to '%s.txt'", path)
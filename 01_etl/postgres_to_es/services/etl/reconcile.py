@@ -0,0 +1,88 @@
+import logging
+from typing import Iterator
+
+from services.etl.metrics import RECONCILE_RANGES
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['RangeReconciler']
+
+HEX_DIGITS = '0123456789abcdef'
+
+
+class RangeReconciler:
+    """
+    Поиск расхождений индекса с PostgreSQL по диапазонам ID фильмов.
+    Диапазон задается префиксом текста ID и сравнивается по количеству
+    фильмов и сумме их контрольных сумм (ID и поля фильма). Обход
+    спускается только в несовпавшие диапазоны, каждый уровень делит
+    диапазон на 16 по следующей цифре ID. Диапазоны не больше leaf_size
+    документов (или на глубине max_depth, не больше 8) сравниваются
+    по документам
+    """
+    batch_ranges = 64
+
+    def __init__(self, pg_client, es_client, leaf_size: int = 1000,
+                 max_depth: int = 6):
+        self.pg_client = pg_client
+        self.es_client = es_client
+        self.leaf_size = leaf_size
+        self.max_depth = min(max(max_depth, 1), 8)
+
+    def compare(self, prefixes: list[str],
+                length: int) -> dict[str, int]:
+        """
+        Сравнивает поддиапазоны prefixes с префиксом длины length.
+        Возвращает несовпавшие поддиапазоны и наибольшее из количеств
+        документов в них
+        """
+        drifted: dict[str, int] = {}
+        for start in range(0, len(prefixes), self.batch_ranges):
+            batch = prefixes[start:start + self.batch_ranges]
+            children = [prefix + digit for prefix in batch
+                        for digit in HEX_DIGITS]
+            source = self.pg_client.get_range_checksums(prefixes=batch,
+                                                        length=length)
+            target = self.es_client.get_range_checksums(prefixes=children)
+            for child in children:
+                expected = source.get(child, (0, 0))
+                actual = target.get(child, (0, 0))
+                if expected != actual:
+                    drifted[child] = max(expected[0], actual[0])
+        RECONCILE_RANGES.labels('matched').inc(
+            len(prefixes) * len(HEX_DIGITS) - len(drifted))
+        RECONCILE_RANGES.labels('drifted').inc(len(drifted))
+        return drifted
+
+    def diff(self, prefix: str) -> tuple[list[str], list[str]]:
+        """
+        Сравнивает диапазон по документам. Возвращает ID фильмов, которые
+        отсутствуют в индексе или устарели, и ID лишних документов.
+        Индекс читается раньше PostgreSQL: фильм, загруженный в индекс во
+        время сверки, уже виден в PostgreSQL и не считается лишним
+        """
+        target = self.es_client.get_range_documents(prefix=prefix)
+        source = self.pg_client.get_range_documents(prefix=prefix)
+        stale = [filmwork_id for filmwork_id, checksum in source.items()
+                 if target.get(filmwork_id) != checksum]
+        extra = [document_id for document_id in target
+                 if document_id not in source]
+        return stale, extra
+
+    def drift(self) -> Iterator[tuple[list[str], list[str]]]:
+        """
+        Обходит пространство ID от крупных диапазонов к мелким и отдает
+        расхождения каждого несовпавшего конечного диапазона
+        """
+        prefixes, length = [''], 0
+        while prefixes:
+            length += 1
+            drifted = self.compare(prefixes=prefixes, length=length)
+            logger.info('Reconcile depth %d: %d of %d ranges drifted',
+                        length, len(drifted), len(prefixes) * len(HEX_DIGITS))
+            prefixes = []
+            for prefix, count in sorted(drifted.items()):
+                if count > self.leaf_size and length < self.max_depth:
+                    prefixes.append(prefix)
+                    continue
+                yield self.diff(prefix=prefix)
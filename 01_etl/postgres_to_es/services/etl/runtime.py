@@ -0,0 +1,186 @@
+import logging
+from pathlib import Path
+from time import sleep
+from typing import Optional
+
+import psycopg2
+from config.settings import es_settings, etl_settings
+from elasticsearch import TransportError
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.pool import ThreadedConnectionPool
+from services.es import ElasticsearchService
+from services.etl.digest import DigestStore
+from services.etl.dlq import DeadLetterQueue
+from services.etl.indexes import IndexDefinition, enabled_indexes
+from services.etl.names import NameStore
+from services.etl.profiler import Profiler, log_dir
+from services.pg import PostgresConnector, PostgresService
+
+logger = logging.getLogger(__name__)
+
+default_file_path: str = f'{Path(__file__).resolve().parents[2]}'
+
+"""
+Ошибки недоступности сервисов, после которых цикл ETL повторяется:
+соединение и ответы Elasticsearch (включая проверку ping),
+соединение с PostgreSQL
+"""
+SERVICE_ERRORS = (ConnectionError, TransportError, OperationalError,
+                  InterfaceError)
+
+
+class Runtime:
+    """
+    Долгоживущие подключения процесса ETL: пул соединений PostgreSQL,
+    один клиент Elasticsearch, хранилища хешей документов и известных
+    имен, журнал отклоненных документов, описания включенных дополнительных
+    индексов и профилировщик по запросу. Создаются один раз при запуске
+    и пересоздаются только после неудачной проверки работоспособности
+    """
+
+    def __init__(self):
+        self.pg_pool: Optional[ThreadedConnectionPool] = None
+        self.pg_client: Optional[PostgresService] = None
+        self.es_client: Optional[ElasticsearchService] = None
+        self.digests: Optional[DigestStore] = None
+        self.names: Optional[NameStore] = None
+        self.dlq: Optional[DeadLetterQueue] = None
+        self.listener: Optional[PostgresService] = None
+        self.indexes: list[IndexDefinition] = []
+        self.profiler = Profiler(
+            path=log_dir(default=default_file_path),
+            cycles=etl_settings.PROFILE_CYCLES,
+            control_file=etl_settings.PROFILE_CONTROL_FILE,
+            top=etl_settings.PROFILE_TOP,
+            memory=etl_settings.PROFILE_MEMORY)
+
+    def __enter__(self):
+        logger.info('Runtime started')
+        if etl_settings.PROFILE_SIGNAL:
+            self.profiler.install(signal_name=etl_settings.PROFILE_SIGNAL)
+        try:
+            self.pg_pool = PostgresConnector().pool()
+            self.pg_client = PostgresService(pool=self.pg_pool)
+            self.es_client = ElasticsearchService()
+            self.indexes = enabled_indexes(es_settings.ES_INDEXES)
+            for definition in self.indexes:
+                self.es_client.ensure_index(index_name=definition.name,
+                                            schema_path=definition.schema)
+            if etl_settings.DIGEST_ENABLED:
+                self.digests = DigestStore(
+                    file_path=default_file_path,
+                    file_name=etl_settings.DIGEST_FILE_NAME)
+            if etl_settings.PARTIAL_UPDATES:
+                self.names = NameStore(
+                    file_path=default_file_path,
+                    file_name=etl_settings.NAMES_FILE_NAME)
+            if etl_settings.DLQ_ENABLED:
+                self.dlq = DeadLetterQueue(
+                    file_path=default_file_path,
+                    dir_name=etl_settings.DLQ_DIR_NAME,
+                    segment_bytes=etl_settings.DLQ_SEGMENT_BYTES,
+                    max_segments=etl_settings.DLQ_MAX_SEGMENTS)
+            if etl_settings.NOTIFY_ENABLED:
+                self.listener = self.listen()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def postgres(self) -> PostgresService:
+        """
+        Возвращает сервис PostgreSQL с отдельным соединением из пула
+        для работы в другом потоке. Закрытие сервиса возвращает
+        соединение в пул
+        """
+        return PostgresService(pool=self.pg_pool)
+
+    def listen(self) -> Optional[PostgresService]:
+        """
+        Открывает отдельное соединение для уведомлений об изменениях.
+        Триггеры устанавливаются отдельной командой (--install-triggers),
+        здесь только проверяется их наличие. Если подписаться не удалось,
+        ETL продолжает работать опросом
+        """
+        channel = etl_settings.NOTIFY_CHANNEL
+        listener = None
+        try:
+            listener = PostgresService()
+            if missing := listener.get_missing_notify_triggers():
+                logger.warning('Notify triggers missing on %s, changes of '
+                               'these tables are found by polling only; '
+                               'run with --install-triggers',
+                               ', '.join(missing))
+            listener.listen(channel=channel)
+        except psycopg2.Error as error:
+            logger.warning('LISTEN unavailable, falling back to polling: %s',
+                           error)
+            if listener is not None:
+                listener.close()
+            return None
+        return listener
+
+    def wait_for_changes(self, timeout: float) -> None:
+        """
+        Пауза между циклами ETL. В событийном режиме завершается сразу
+        после пачки уведомлений об изменениях, иначе по истечении
+        timeout (опрос остается запасным вариантом)
+        """
+        if self.listener is None:
+            logger.info('Pause %s seconds', timeout)
+            sleep(timeout)
+            return
+
+        try:
+            tables = self.listener.wait_notifications(
+                timeout=timeout,
+                debounce=etl_settings.NOTIFY_DEBOUNCE,
+                max_delay=etl_settings.NOTIFY_MAX_DELAY)
+        except (OperationalError, InterfaceError) as error:
+            """Изменения за время потери связи подберет следующий цикл"""
+            logger.warning('Listener connection lost: %s', error)
+            self.listener.close()
+            self.listener = self.listen()
+            return
+        if tables:
+            logger.info('Changes notified: %s', ', '.join(sorted(tables)))
+        else:
+            logger.info('No notifications for %s seconds, polling', timeout)
+
+    def check_health(self) -> None:
+        """Пересоздает подключения, которые перестали отвечать"""
+        if not self.pg_client.is_alive():
+            logger.warning('PostgreSQL connection is broken, reconnecting')
+            self.pg_client.reconnect()
+
+        if not self.es_client.is_alive():
+            logger.warning('Elasticsearch is unavailable, reconnecting')
+            self.es_client.reconnect()
+
+    def close(self) -> None:
+        logger.info('Close all connections ...')
+        if self.es_client is not None:
+            self.es_client.close()
+
+        if self.pg_client is not None:
+            self.pg_client.close()
+
+        if self.digests is not None:
+            self.digests.close()
+
+        if self.names is not None:
+            self.names.close()
+
+        if self.listener is not None:
+            self.listener.close()
+
+        if self.dlq is not None:
+            self.dlq.close()
+
+        if self.pg_pool is not None:
+            self.pg_pool.closeall()
+            logger.info('PostgreSQL pool closed')
+        logger.info('Runtime stopped')
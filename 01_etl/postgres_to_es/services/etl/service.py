@@ -1,174 +1,663 @@
 import logging
 from datetime import datetime
-from time import sleep
-from typing import Optional
+from itertools import islice
+from time import perf_counter, time
+from typing import Callable, Iterable, Iterator, Optional
 
 from config.settings import etl_settings
-from services.es import ElasticsearchService
-from services.pg import PostgresService, models
+from services.etl.indexes import IndexDefinition
+from services.etl.lease import shard_of
+from services.etl.metrics import (BATCH_DOCUMENTS, DLQ_DOCUMENTS,
+                                  RECONCILE_DOCUMENTS, STAGE_DOCUMENTS,
+                                  STAGE_SECONDS, observe_watermarks, timed)
+from services.etl.reconcile import RangeReconciler
+from services.etl.transform import transform_filmworks
+from services.pg import models, queries
 
 logger = logging.getLogger(__name__)
 
 
 class ETL:
-    def __init__(self, settings=etl_settings, state=None):
+    def __init__(self, runtime, settings=etl_settings, state=None,
+                 shard: Optional[tuple[int, int]] = None,
+                 on_heartbeat: Optional[Callable[[], None]] = None):
         self.conf = settings
         self.state = state
+        self.runtime = runtime
+        self.shard = shard
+        self.on_heartbeat = on_heartbeat
         self.pg_client = None
+        self.load_pg_client = None
         self.es_client = None
         self.states = None
+        self.caught_up = True
+        self.digests = None
+        self.names = None
+        self.dlq = None
+        self.pending_digests: dict[str, str] = {}
+        self.updates: dict[str, dict] = {'persons': {}, 'genres': {}}
+        self.indexes: list[IndexDefinition] = []
+        self.changes: dict[str, set[str]] = {}
+        self.profiler = None
 
     def __enter__(self):
         logger.info('ETL process started')
-        self.state.set_state('etl_process', 'started')
+        self.runtime.check_health()
+        self.pg_client = self.runtime.pg_client
+        self.load_pg_client = self.pg_client
+        self.es_client = self.runtime.es_client
+        self.digests = self.runtime.digests
+        self.names = self.runtime.names
+        self.dlq = self.runtime.dlq
+        self.indexes = self.runtime.indexes
+        self.profiler = self.runtime.profiler
+        self.states = self.state.get_state('modified') or {}
+        """Известные имена прежних версий хранились вместе с курсорами"""
+        self.states.pop('persons', None)
+        self.states.pop('genres', None)
+        if self.names is not None:
+            self.seed_names()
+        self.heartbeat()
+        return self
 
-        try:
-            self.pg_client = PostgresService()
-            self.es_client = ElasticsearchService()
-        except Exception:
-            self.state.set_state('etl_process', 'stopped')
-            raise
+    def __exit__(self, type, value, traceback):
+        logger.info('ETL process stopped')
+
+    def heartbeat(self) -> None:
+        """
+        Отмечает, что процесс жив: обновляет метку времени в состоянии
+        и продлевает аренду шарда, если процесс работает с шардами
+        """
+        self.state.set_state('etl_heartbeat', time())
+        if self.on_heartbeat is not None:
+            self.on_heartbeat()
+
+    def get_cursor(self, source: str) -> dict:
+        """
+        Возвращает позицию курсора (modified, id) источника изменений.
+        Состояние в старом формате (только modified) продолжает работу
+        с этой временной метки
+        """
+        cursor = self.states.get(source)
+        if isinstance(cursor, dict):
+            return cursor
+        return {'modified': cursor or f'{datetime.min}',
+                'id': queries.MIN_ID}
+
+    def set_cursor(self, source: str, rows: list) -> None:
+        """Сдвигает курсор источника на последнюю прочитанную запись"""
+        self.states[source] = {'modified': f'{rows[-1].modified}',
+                               'id': rows[-1].id}
+        if len(rows) >= self.conf.LIMIT:
+            self.caught_up = False
+
+    def fan_out(self, source: str, get_changes: Callable,
+                get_filmworks: Callable,
+                plan: Optional[Callable] = None) -> list[str]:
+        """
+        Разворачивает изменения источника (персонажи, жанры) в ID
+        связанных фильмов порциями не больше FANOUT_LIMIT.
+        ID прочитанных изменений копятся в self.changes для
+        дополнительных индексов.
+        Незавершенная задача хранится в состоянии: ID измененных записей,
+        последний выданный ID фильма и курсор источника, на который
+        он переводится после выдачи последней порции.
+        plan получает страницу изменений и возвращает ID записей, для
+        которых нужна полная пересборка фильмов, и ID переименованных
+        записей: их фильмы пересобираются только там, где документ
+        хранит имя без ID (режиссеры)
+        """
+        tasks: dict = self.states.setdefault('fanout', {})
+        if (task := tasks.get(source)) is None:
+            cursor = self.get_cursor(source)
+            if not (rows := get_changes(modified=cursor['modified'],
+                                        last_id=cursor['id'])):
+                return []
+            self.changes[source].update(row.id for row in rows)
+            ids, renamed = (plan(rows) if plan
+                            else ([row.id for row in rows], []))
+            task = tasks[source] = {
+                'ids': ids,
+                'renamed': renamed,
+                'after': queries.MIN_ID,
+                'cursor': {'modified': f'{rows[-1].modified}',
+                           'id': rows[-1].id},
+                'full_page': len(rows) >= self.conf.LIMIT,
+            }
+
+        filmwork_ids = []
+        if renamed := task.get('renamed'):
+            filmwork_ids = get_filmworks(task['ids'], task['after'],
+                                         renamed=renamed)
+        elif task['ids']:
+            filmwork_ids = get_filmworks(task['ids'], task['after'])
+        if len(filmwork_ids) >= self.conf.FANOUT_LIMIT:
+            task['after'] = filmwork_ids[-1]
+            self.caught_up = False
         else:
-            self.states = self.state.get_state('modified') or {}
-            return self
+            self.states[source] = task['cursor']
+            del tasks[source]
+            if task['full_page']:
+                self.caught_up = False
+        return filmwork_ids
 
-    def __exit__(self, type, value, traceback):
-        logger.info('Close all connections ...')
-        if self.es_client is not None:
-            self.es_client.close()
+    @property
+    def names_scope(self) -> str:
+        """Область хранилища имен: своя у каждого шарда"""
+        return f'shard-{self.shard[0]}' if self.shard is not None else ''
 
-        if self.pg_client is not None:
-            self.pg_client.close()
+    def seed_names(self, replace: bool = False) -> None:
+        """
+        Заполняет хранилище имен текущими именами из PostgreSQL, если
+        область пуста (или replace). Имя, измененное до заполнения,
+        не распознается как переименование, и фильмы пересобираются
+        полностью
+        """
+        for kind in ('person', 'genre'):
+            if replace or self.names.is_empty(kind, self.names_scope):
+                self.names.seed(kind, self.names_scope,
+                                self.pg_client.stream_names(kind=kind))
 
-        logger.info('ETL process stopped')
-        self.state.set_state('etl_process', 'stopped')
+    def known_names(self, kind: str, records: list,
+                    field: str) -> dict[str, str]:
+        """
+        Возвращает известные имена записей и запоминает текущие.
+        Если пакет не будет загружен, повторно прочитанные записи
+        пересобираются полностью
+        """
+        ids = [record.id for record in records]
+        known = self.names.lookup(kind, self.names_scope, ids)
+        self.names.save(kind, self.names_scope, {
+            record.id: getattr(record, field) for record in records})
+        return known
+
+    def plan_persons(self, persons: list) -> tuple[list, list]:
+        """
+        Сравнивает имена персонажей с известными по хранилищу имен.
+        Переименования применяются частичным обновлением документов,
+        а пересобираются только фильмы, где персонаж режиссер (в документе
+        режиссеры хранятся без ID). Фильмы новых персонажей и персонажей,
+        измененных без смены имени, пересобираются полностью
+        """
+        known = self.known_names('person', persons, field='full_name')
+        rebuild: list[str] = []
+        renamed: list[str] = []
+        for person in persons:
+            previous = known.get(person.id)
+            if previous is None or previous == person.full_name:
+                rebuild.append(person.id)
+            else:
+                self.updates['persons'][person.id] = person.full_name
+                renamed.append(person.id)
+        return rebuild, renamed
 
-        logger.info('Pause %s seconds', etl_settings.UPLOAD_INTERVAL)
-        sleep(self.conf.UPLOAD_INTERVAL)
+    def plan_genres(self, genres: list) -> tuple[list, list]:
+        """
+        Сравнивает названия жанров с известными по хранилищу имен.
+        Переименования применяются частичным обновлением документов,
+        изменения без смены названия пропускаются, а фильмы неизвестных
+        жанров пересобираются полностью
+        """
+        known = self.known_names('genre', genres, field='name')
+        rebuild: list[str] = []
+        for genre in genres:
+            previous = known.get(genre.id)
+            if previous is None:
+                rebuild.append(genre.id)
+            elif previous != genre.name:
+                self.updates['genres'][previous] = genre.name
+        return rebuild, []
 
     def extract(self) -> None:
         """
-        Извлекает из PostgreSQL все новые/измененные
-        данные (жанры, персонажи и фильмы).
-        Возвращает количество уникальных ID фильмов и экземпляры фильмов
+        Извлекает из PostgreSQL очередную страницу новых/измененных
+        данных (жанры, персонажи и фильмы).
+        Возвращает количество уникальных ID фильмов и экземпляры фильмов.
+        Если хотя бы один источник вернул полную страницу, caught_up
+        сбрасывается и извлечение нужно повторить
         """
-        person_filmwork_ids: list[str] = []
-        genre_filmwork_ids: list[str] = []
+        started = perf_counter()
         filmwork_ids: list[str] = []
-        modified_person: str = self.states.get('person') or datetime.min
-        modified_genre: str = self.states.get('genre') or datetime.min
-        modified_filmwork: str = self.states.get('filmwork') or datetime.min
+        filmwork_cursor: dict = self.get_cursor('filmwork')
+        self.caught_up = True
+        self.updates = {'persons': {}, 'genres': {}}
+        self.changes = {'person': set(), 'genre': set(), 'filmwork': set()}
 
         """
-        Получаем список ID новых/измененныех персонажей и список ID фильмов
-        свызанных, в которых участвуют выбранные персонажи
+        Получаем очередную порцию ID фильмов, в которых участвуют
+        новые/измененные персонажи
         """
-        if persons := self.pg_client.get_modified_person(
-                timestamp=modified_person):
-            self.states['person'] = f'{persons[-1].modified}'
-            person_filmwork_ids = self.pg_client.get_filmwork_by_person(
-                persons=[person.id for person in persons])
+        person_filmwork_ids = self.fan_out(
+            source='person',
+            get_changes=self.pg_client.get_modified_person,
+            get_filmworks=self.pg_client.get_filmwork_by_person,
+            plan=self.plan_persons if self.names is not None else None)
 
         """
-        Получаем список ID новых/измененных жанров и список ID фильмов
-        по выбранным жанрам
+        Получаем очередную порцию ID фильмов по новым/измененным жанрам
         """
-        if genres := self.pg_client.get_modified_genre(
-                timestamp=modified_genre):
-            self.states['genre'] = f'{genres[-1].modified}'
-            genre_filmwork_ids = self.pg_client.get_filmwork_by_genre(
-                genres=[genre.id for genre in genres])
+        genre_filmwork_ids = self.fan_out(
+            source='genre',
+            get_changes=self.pg_client.get_modified_genre,
+            get_filmworks=self.pg_client.get_filmwork_by_genre,
+            plan=self.plan_genres if self.names is not None else None)
 
         """
         Получаем список ID новых/измененных фильмов
         """
         if filmworks := self.pg_client.get_modified_filmwork(
-                timestamp=modified_filmwork):
-            self.states['filmwork'] = f'{genres[-1].modified}'
+                modified=filmwork_cursor['modified'],
+                last_id=filmwork_cursor['id']):
+            self.set_cursor('filmwork', filmworks)
             filmwork_ids = [filmwork.id for filmwork in filmworks]
+            self.changes['filmwork'].update(filmwork_ids)
 
         """Формируем множество уникальных ID новых/измененных фильмов"""
         unique_filmwork_ids = set(
             filmwork_ids + person_filmwork_ids + genre_filmwork_ids)
+        if self.shard is not None:
+            shard, shards = self.shard
+            unique_filmwork_ids = {
+                filmwork_id for filmwork_id in unique_filmwork_ids
+                if shard_of(filmwork_id, shards) == shard}
 
+        """Возвращаем все новые/измененные экземпляры фильмов"""
+        filmwork_instances = self.get_filmworks(ids=unique_filmwork_ids)
+
+        STAGE_SECONDS.labels('extract').observe(perf_counter() - started)
+        STAGE_DOCUMENTS.labels('extract').inc(len(unique_filmwork_ids))
+        BATCH_DOCUMENTS.labels('extract').observe(len(unique_filmwork_ids))
+        return len(unique_filmwork_ids), filmwork_instances
+
+    def get_filmworks(self, ids: Iterable[str], pg_client=None):
         """
-        Возвращаем все новые/измененные экземпляры фильмов
+        Возвращает экземпляры фильмов по ID. В режиме aggregate
+        PostgreSQL возвращает уже собранные документы
         """
-        filmwork_instances = self.pg_client.get_filmwork_instances(
-            ids=tuple(unique_filmwork_ids))
-        return len(unique_filmwork_ids), filmwork_instances
+        pg_client = pg_client or self.pg_client
+        if self.conf.EXTRACT_MODE == 'aggregate':
+            return pg_client.get_filmwork_documents(ids=tuple(ids))
+        return pg_client.get_filmwork_instances(ids=tuple(ids))
 
-    def transform(self, modified_data) -> None:
+    def transform(self, modified_data) -> Iterator[dict]:
         """
         Трансформирует извлеченные экземпляры фильмов для Elasticsearch.
         Формирует список уникальных фильмов с группировкой списков и
-        экземпляров genre, director, actor, writer
-        """
-        if modified_data is not None:
-            transformed_data: list = []
-            filmwork_ids: set = {filmwork.get('fw_id')
-                                 for filmwork in modified_data}
-            for filmwork_id in filmwork_ids:
-                genres: Optional[list[str]] = []
-                directors: Optional[list[str]] = []
-                actors_names: Optional[list[str]] = []
-                writers_names: Optional[list[str]] = []
-                actors: Optional[list[dict[str, str]]] = []
-                writers: Optional[list[dict[str, str]]] = []
-                for filmwork in modified_data:
-                    if filmwork.get('fw_id') == filmwork_id:
-                        imdb_rating = filmwork.get('rating')
-                        title = filmwork.get('title')
-                        description = filmwork.get('description')
-                        if filmwork.get('genre') not in genres:
-                            genres.append(filmwork.get('genre'))
-                        person_name = filmwork.get('full_name')
-                        person_instance = {'id': filmwork.get('person_id'),
-                                           'name': person_name}
-                        if filmwork.get('role') == 'director':
-                            if person_name not in directors:
-                                directors.append(person_name)
-                        elif filmwork.get('role') == 'actor':
-                            if person_name not in actors_names:
-                                actors_names.append(person_name)
-                            if person_instance not in actors:
-                                actors.append(person_instance)
-                        elif filmwork.get('role') == 'writer':
-                            if person_name not in writers_names:
-                                writers_names.append(person_name)
-                            if person_instance not in writers:
-                                writers.append(person_instance)
-                        new_filmwork = {
-                            'id': filmwork_id,
-                            'imdb_rating': imdb_rating,
-                            'title': title,
-                            'description': description,
-                            'genre': genres,
-                            'director': directors,
-                            'actors_names': actors_names,
-                            'writers_names': writers_names,
-                            'actors': actors,
-                            'writers': writers,
-                        }
-                transformed_data.append(new_filmwork)
-            for filmwork in transformed_data:
-                yield models.ESFilmworkModel(**filmwork).dict()
-
-    def load(self, transformed_data):
-        """
-        Формируем пакеты фильмов и загружаем их в Elasticsearch
-        """
-        actions: list = []
-        for data in transformed_data:
-            actions.append(data)
-            if len(actions) == self.conf.LIMIT:
-                self.es_client.transfer_data(actions=actions)
-                actions.clear()
+        экземпляров genre, director, actor, writer.
+        В режиме aggregate документы уже собраны и только валидируются.
+        Схема проверяется моделью один раз на пакет, остальные документы
+        проходят быструю проверку полей
+        """
+        if self.conf.EXTRACT_MODE == 'aggregate':
+            filmworks = modified_data or []
         else:
-            if actions:
-                self.es_client.transfer_data(actions=actions)
-                pass
+            filmworks = transform_filmworks(rows=modified_data)
+        return timed(models.validate_filmworks(filmworks),
+                     stage='transform')
+
+    def skip_unchanged(self, transformed_data,
+                       pending: Optional[dict] = None) -> Iterator[dict]:
+        """
+        Отбрасывает документы, которые не изменились с последней загрузки.
+        Хеши отправляемых документов копятся в pending (по умолчанию
+        в self.pending_digests) и сохраняются вместе с состоянием
+        """
+        if self.digests is None:
+            return iter(transformed_data)
+        if pending is None:
+            pending = self.pending_digests
+        return self.digests.skip_unchanged(documents=transformed_data,
+                                           pending=pending)
+
+    def load(self, transformed_data, index_name: Optional[str] = None,
+             pending: Optional[dict] = None) -> int:
+        """
+        Загружаем фильмы в Elasticsearch окнами, размер которых
+        позволяет загрузчику держать занятыми все потоки.
+        Отклоненные документы записываются в журнал отказов. В pending
+        остаются только хеши документов, загрузку которых подтвердил
+        Elasticsearch: следующая сборка отклоненного или оставшегося без
+        ответа фильма не будет пропущена как неизмененная.
+        Возвращает число отказов
+        """
+        if pending is None:
+            pending = self.pending_digests
+        documents = iter(transformed_data)
+        failed = 0
+        while window := list(islice(documents, self.es_client.window_size)):
+            started = perf_counter()
+            succeeded, failures = self.es_client.transfer_data(
+                actions=window, index_name=index_name)
+            STAGE_SECONDS.labels('load').observe(perf_counter() - started)
+            STAGE_DOCUMENTS.labels('load').inc(len(window))
+            BATCH_DOCUMENTS.labels('load').observe(len(window))
+            confirmed = set(succeeded)
+            for document in window:
+                if document['id'] not in confirmed:
+                    pending.pop(document['id'], None)
+            if failures and self.dlq is not None:
+                self.dlq.append(failures=failures,
+                                index_name=index_name
+                                or self.es_client.index_name)
+            failed += len(failures)
+        return failed
+
+    def reload(self, ids: list[str]) -> int:
+        """
+        Заново собирает и загружает фильмы по ID страницами FANOUT_LIMIT.
+        Запросы идут через соединение стадии загрузки (load_pg_client).
+        Возвращает число отказов
+        """
+        failed = 0
+        for start in range(0, len(ids), self.conf.FANOUT_LIMIT):
+            page = ids[start:start + self.conf.FANOUT_LIMIT]
+            failed += self.load(transformed_data=self.skip_unchanged(
+                self.transform(modified_data=self.get_filmworks(
+                    ids=page, pg_client=self.load_pg_client))))
+            if self.digests is not None:
+                self.digests.save(pending=self.pending_digests)
+        return failed
+
+    def reload_index(self, definition: IndexDefinition,
+                     ids: list[str]) -> int:
+        """
+        Собирает и загружает документы дополнительного индекса по ID
+        страницами FANOUT_LIMIT. Документы ID, которых выборка больше
+        не возвращает, удаляются. Возвращает число отказов
+        """
+        failed = 0
+        for start in range(0, len(ids), self.conf.FANOUT_LIMIT):
+            page = ids[start:start + self.conf.FANOUT_LIMIT]
+            documents = self.load_pg_client.get_documents(
+                query=definition.query, ids=page)
+            found = {f'{document["id"]}' for document in documents}
+            if gone := [document_id for document_id in page
+                        if document_id not in found]:
+                self.es_client.delete_data(ids=gone,
+                                           index_name=definition.name)
+            failed += self.load(
+                transformed_data=definition.transform(documents),
+                index_name=definition.name, pending={})
+        return failed
+
+    def sweep_index(self, definition: IndexDefinition) -> int:
+        """
+        Удаляет из дополнительного индекса документы записей, удаленных
+        в PostgreSQL: удаление не попадает в выборку изменений.
+        Возвращает количество удаленных документов
+        """
+        ids = self.es_client.get_ids(index_name=definition.name)
+        deleted = 0
+        for start in range(0, len(ids), self.conf.FANOUT_LIMIT):
+            page = ids[start:start + self.conf.FANOUT_LIMIT]
+            existing = set(self.pg_client.get_related_ids(
+                query=definition.existing, ids=page))
+            if gone := [document_id for document_id in page
+                        if document_id not in existing]:
+                deleted += self.es_client.delete_data(
+                    ids=gone, index_name=definition.name)
+        RECONCILE_DOCUMENTS.labels('extra').inc(deleted)
+        logger.info("Index '%s' swept: %d documents deleted",
+                    definition.name, deleted)
+        return deleted
+
+    def index_ids(self, definition: IndexDefinition,
+                  changes: dict[str, set[str]]) -> list[str]:
+        """ID документов дополнительного индекса, затронутых изменениями"""
+        ids: set[str] = set()
+        for source, query in definition.sources.items():
+            if not (changed := changes.get(source)):
+                continue
+            if query is None:
+                ids.update(changed)
+            else:
+                ids.update(self.load_pg_client.get_related_ids(
+                    query=query, ids=changed))
+        if self.shard is not None:
+            shard, shards = self.shard
+            ids = {document_id for document_id in ids
+                   if shard_of(document_id, shards) == shard}
+        return sorted(ids)
+
+    def load_indexes(self, changes: dict[str, set[str]]) -> None:
+        """
+        Загружает в дополнительные индексы документы, затронутые
+        изменениями того же прохода извлечения, что и фильмы пакета:
+        источники изменений читаются один раз для всех индексов
+        """
+        for definition in self.indexes:
+            if ids := self.index_ids(definition=definition, changes=changes):
+                logger.info("Load %d documents into index '%s'", len(ids),
+                            definition.name)
+                self.reload_index(definition=definition, ids=ids)
+
+    def replay_dead_letters(self) -> int:
+        """
+        Повторно извлекает из PostgreSQL и загружает только документы из
+        журнала отказов: фильмы и документы дополнительных индексов.
+        Обработанные сегменты удаляются, повторные отказы попадают
+        в новый сегмент. Возвращает число документов
+        """
+        segments = self.dlq.seal()
+        entries = self.dlq.read_ids(segments)
+        total = sum(len(ids) for ids in entries.values())
+        logger.info('Replay %d dead-lettered documents from %d segments',
+                    total, len(segments))
+        definitions = {definition.name: definition
+                       for definition in self.indexes}
+        filmwork_ids: dict[str, None] = {}
+        failed = 0
+        for index_name, ids in entries.items():
+            """Отказы версии индекса при полной переиндексации"""
+            if index_name not in definitions:
+                index_name = index_name.rpartition('_')[0]
+            if (definition := definitions.get(index_name)) is not None:
+                failed += self.reload_index(definition=definition, ids=ids)
+            else:
+                filmwork_ids.update(dict.fromkeys(ids))
+        failed += self.reload(ids=list(filmwork_ids))
+        self.dlq.remove(segments)
+        DLQ_DOCUMENTS.labels('replayed').inc(total - failed)
+        logger.info('Dead letters replayed: %d, failed again: %d',
+                    total - failed, failed)
+        return total
+
+    @property
+    def reconcile_due(self) -> bool:
+        """Пора ли выполнить очередную сверку (RECONCILE_INTERVAL)"""
+        interval = self.conf.RECONCILE_INTERVAL
+        reconciled = self.state.get_state('reconciled_at') or 0
+        return bool(interval) and time() - reconciled >= interval
+
+    def reconcile(self) -> dict[str, int]:
+        """
+        Сверяет рабочий индекс с PostgreSQL по контрольным суммам
+        диапазонов ID и исправляет расхождения: недостающие и устаревшие
+        фильмы загружаются заново, лишние документы удаляются.
+        Из дополнительных индексов удаляются документы удаленных записей.
+        Возвращает количество исправленных документов
+        """
+        reconciler = RangeReconciler(pg_client=self.pg_client,
+                                     es_client=self.es_client,
+                                     leaf_size=self.conf.RECONCILE_LEAF_SIZE,
+                                     max_depth=self.conf.RECONCILE_MAX_DEPTH)
+        counter = {'stale': 0, 'extra': 0}
+        for stale, extra in reconciler.drift():
+            if self.digests is not None:
+                """Хеш совпадает, но документ в индексе другой"""
+                self.digests.invalidate(stale + extra)
+            if stale:
+                self.reload(ids=stale)
+            if extra:
+                self.es_client.delete_data(ids=extra)
+            counter['stale'] += len(stale)
+            counter['extra'] += len(extra)
+            RECONCILE_DOCUMENTS.labels('stale').inc(len(stale))
+            RECONCILE_DOCUMENTS.labels('extra').inc(len(extra))
+            self.heartbeat()
+        for definition in self.indexes:
+            counter['extra'] += self.sweep_index(definition=definition)
+            self.heartbeat()
+        self.state.set_state('reconciled_at', time())
+        logger.info('Reconcile finished: reloaded %d, deleted %d',
+                    counter['stale'], counter['extra'])
+        return counter
+
+    def apply_updates(self, updates: dict[str, dict]) -> None:
+        """
+        Применяет частичные обновления документов после загрузки
+        пересобранных фильмов того же пакета. Хеши измененных фильмов
+        забываются: документ в индексе больше не совпадает с последней
+        полной сборкой. Фильмы, которые не удалось обновить частично,
+        пересобираются полностью
+        """
+        if not (updates['persons'] or updates['genres']):
+            return
+        if self.shard is not None and self.shard[0] != 0:
+            self.forget_renamed(updates=updates)
+            return
+        results: list[tuple[list[str], bool]] = []
+        with STAGE_SECONDS.labels('apply_updates').time():
+            if updates['persons']:
+                results.append(
+                    self.es_client.rename_persons(names=updates['persons']))
+            if updates['genres']:
+                results.append(
+                    self.es_client.rename_genres(renames=updates['genres']))
+            rebuild: list[str] = []
+            for ids, complete in results:
+                if self.digests is not None:
+                    self.digests.invalidate(ids)
+                if not complete:
+                    rebuild.extend(ids)
+            if rebuild:
+                self.reload(ids=list(dict.fromkeys(rebuild)))
+
+    def forget_renamed(self, updates: dict[str, dict]) -> None:
+        """
+        Частичные обновления затрагивают весь индекс, поэтому при работе
+        с шардами их применяет только процесс шарда 0. Остальные шарды
+        только забывают хеши своих фильмов с переименованными персонажами
+        и жанрами
+        """
+        if self.digests is None:
+            return
+        es_queries = []
+        if updates['persons']:
+            es_queries.append(
+                self.es_client.persons_query(ids=list(updates['persons'])))
+        if updates['genres']:
+            es_queries.append(
+                self.es_client.genres_query(names=list(updates['genres'])))
+        shard, shards = self.shard
+        for query in es_queries:
+            self.digests.invalidate(
+                filmwork_id
+                for filmwork_id in self.es_client.matching_ids(query=query)
+                if shard_of(filmwork_id, shards) == shard)
+
+    def full_reindex(self, blue_green: bool = True) -> int:
+        """
+        Переиндексирует весь каталог фильмов. Строки читаются серверным
+        курсором и проходят transform и load как генераторы, поэтому
+        потребление памяти не зависит от размера каталога.
+        В режиме blue_green загрузка идет в новую версию индекса, на которую
+        после загрузки переключается псевдоним рабочего индекса.
+        После загрузки курсоры всех источников переводятся на момент
+        начала выгрузки. Возвращает количество загруженных документов
+        """
+        snapshot_time = self.pg_client.get_snapshot_time()
+        if self.digests is not None:
+            self.digests.clear()
+        if self.names is not None:
+            self.seed_names(replace=True)
+        started = perf_counter()
+        progress = {'documents': 0}
+        index_name = None
+        if blue_green:
+            index_name = self.es_client.create_versioned_index()
+
+        logger.info('Full reindex started, snapshot at %s', snapshot_time)
+        transformed_data = self.transform(
+            modified_data=self.pg_client.stream_filmworks())
+        try:
+            self.load(transformed_data=self.progress(
+                documents=transformed_data, counter=progress,
+                started=started), index_name=index_name)
+        except Exception:
+            if blue_green:
+                self.es_client.delete_index(index_name=index_name)
+            raise
+        if blue_green:
+            self.es_client.promote_index(index_name=index_name)
+
+        elapsed = perf_counter() - started
+        logger.info('Full reindex completed: %d documents in %.1f s '
+                    '(%.1f docs/sec)', progress['documents'], elapsed,
+                    progress['documents'] / elapsed if elapsed else 0)
+
+        for source in ('person', 'genre', 'filmwork'):
+            self.states[source] = {'modified': snapshot_time,
+                                   'id': queries.MIN_ID}
+        for definition in self.indexes:
+            progress['documents'] += self.reindex(definition=definition,
+                                                  blue_green=blue_green)
+
+        self.states.pop('fanout', None)
+        self.save_state()
+        return progress['documents']
+
+    def reindex(self, definition: IndexDefinition,
+                blue_green: bool = True) -> int:
+        """
+        Переиндексирует дополнительный индекс из потоковой выборки,
+        в режиме blue_green - через новую версию индекса.
+        Возвращает количество загруженных документов
+        """
+        progress = {'documents': 0}
+        index_name = definition.name
+        if blue_green:
+            index_name = self.es_client.create_versioned_index(
+                alias=definition.name)
+        documents = definition.transform(
+            dict(row) for row in self.pg_client.stream(
+                query=definition.stream))
+        try:
+            self.load(transformed_data=self.progress(
+                documents=documents, counter=progress,
+                started=perf_counter()), index_name=index_name, pending={})
+        except Exception:
+            if blue_green:
+                self.es_client.delete_index(index_name=index_name)
+            raise
+        if blue_green:
+            self.es_client.promote_index(index_name=index_name,
+                                         alias=definition.name)
+        logger.info("Index '%s' reindexed: %d documents", definition.name,
+                    progress['documents'])
+        return progress['documents']
+
+    def progress(self, documents: Iterable[dict], counter: dict,
+                 started: float) -> Iterator[dict]:
+        """
+        Пропускает документы дальше по конвейеру и периодически
+        сообщает о ходе загрузки
+        """
+        report_every = self.conf.LIMIT * 10
+        for document in documents:
+            counter['documents'] += 1
+            if counter['documents'] % report_every == 0:
+                elapsed = perf_counter() - started
+                logger.info('Reindex progress: %d documents, %.1f docs/sec',
+                            counter['documents'],
+                            counter['documents'] / elapsed)
+                self.heartbeat()
+            yield document
 
     def save_state(self):
-        """Сохраняем последнее состояние"""
+        """Сохраняем последнее состояние и хеши загруженных документов"""
         self.state.set_state('modified', self.states)
+        if self.digests is not None:
+            self.digests.save(pending=self.pending_digests)
+        observe_watermarks(states=self.states, caught_up=self.caught_up)
+        self.heartbeat()
@@ -1,11 +1,18 @@
 import abc
+import copy
 import json
+import logging
 import os
+import sqlite3
+import threading
 from pathlib import Path
+from time import monotonic
 from typing import Any, Optional, Union
 
 from config.settings import etl_settings
 
+logger = logging.getLogger(__name__)
+
 state_file_name: str = etl_settings.STATE_FILE_NAME
 default_file_path: str = f'{Path(__file__).resolve().parent}'
 
@@ -21,6 +28,45 @@ class BaseStorage:
         """Загрузить состояние локально из постоянного хранилища"""
         pass
 
+    def close(self) -> None:
+        """Сохранить несохраненные изменения и освободить ресурсы"""
+        pass
+
+
+def atomic_write_json(file_state: str, state: dict) -> None:
+    """
+    Записывает состояние во временный файл и атомарно подменяет им
+    основной, поэтому при сбое на диске остается либо старая,
+    либо новая версия целиком
+    """
+    tmp_file = f'{file_state}.tmp'
+    with open(tmp_file, 'w') as storage:
+        json.dump(state, storage, ensure_ascii=False, indent=4)
+        storage.flush()
+        os.fsync(storage.fileno())
+    os.replace(tmp_file, file_state)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(file_state)),
+                     os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_legacy_state(file_path: str, file_name: str) -> Optional[dict]:
+    """
+    Состояние из файла JsonFileStorage: его путь - простое сложение
+    file_path и имени файла. Позволяет сменить хранилище без потери
+    курсоров и отметки о запущенном процессе
+    """
+    legacy_state = f'{file_path}{file_name}'
+    if not os.path.exists(legacy_state):
+        return None
+    with open(legacy_state, 'r') as storage:
+        state = json.load(storage)
+    logger.warning("State loaded from legacy file '%s'", legacy_state)
+    return state
+
 
 class JsonFileStorage(BaseStorage):
     def __init__(self, file_path: Optional[str] = None,
@@ -28,13 +74,13 @@ class JsonFileStorage(BaseStorage):
         self.file_path = file_path
         self.file_name = file_name
         self.file_state = f'{self.file_path}{state_file_name}'
+        self.lock = threading.Lock()
 
     def save_state(self, state: dict) -> None:
         """Сохранить состояние в постоянное хранилище"""
-        file_state = self.retrieve_state() or {}
-        with open(self.file_state, 'w') as storage:
-            save_state: dict = {**file_state, **state}
-            json.dump(save_state, storage, ensure_ascii=False, indent=4)
+        with self.lock:
+            file_state = self.retrieve_state() or {}
+            atomic_write_json(self.file_state, {**file_state, **state})
 
     def retrieve_state(self) -> Union[dict, None]:
         """Загрузить состояние локально из постоянного хранилища"""
@@ -45,6 +91,120 @@ class JsonFileStorage(BaseStorage):
             return None
 
 
+class MemoryJsonStorage(BaseStorage):
+    """
+    Состояние хранится в памяти, а в JSON-файл сбрасывается атомарной
+    записью не чаще одного раза в flush_interval секунд: частые
+    set_state объединяются в одну запись. При сбое теряются только
+    изменения последнего интервала, которые будут обработаны повторно
+    """
+
+    def __init__(self, file_path: str, file_name: str,
+                 flush_interval: float = 1.0):
+        self.file_state = os.path.join(file_path, file_name)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.timer: Optional[threading.Timer] = None
+        self.dirty = False
+        self.flushed_at = monotonic()
+        self.state: dict = {}
+        if os.path.exists(self.file_state):
+            with open(self.file_state, 'r') as storage:
+                self.state = json.load(storage)
+        else:
+            self.state = read_legacy_state(file_path, file_name) or {}
+
+    def save_state(self, state: dict) -> None:
+        """Сохранить состояние в памяти и запланировать запись на диск"""
+        with self.lock:
+            self.state.update(copy.deepcopy(state))
+            self.dirty = True
+            if monotonic() - self.flushed_at >= self.flush_interval:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def retrieve_state(self) -> dict:
+        """Загрузить состояние из памяти"""
+        with self.lock:
+            return copy.deepcopy(self.state)
+
+    def flush(self) -> None:
+        """Записать несохраненные изменения на диск"""
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.dirty:
+            atomic_write_json(self.file_state, self.state)
+            self.dirty = False
+        self.flushed_at = monotonic()
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Состояние хранится в SQLite: каждый вызов save_state обновляет
+    ключи в одной транзакции. Файл базы отделен от JSON-файла состояния
+    (legacy_file_name), пустая база при открытии заполняется из него
+    """
+
+    def __init__(self, file_path: str, file_name: str,
+                 legacy_file_name: Optional[str] = None):
+        self.file_state = os.path.join(file_path, file_name)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.file_state, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS state '
+                              '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if legacy_file_name and self.retrieve_state() is None:
+            legacy_state = read_legacy_state(file_path, legacy_file_name)
+            if legacy_state:
+                self.save_state(legacy_state)
+
+    def save_state(self, state: dict) -> None:
+        """Сохранить состояние в постоянное хранилище"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                    [(key, json.dumps(value, ensure_ascii=False))
+                     for key, value in state.items()])
+
+    def retrieve_state(self) -> Optional[dict]:
+        """Загрузить состояние из постоянного хранилища"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT key, value FROM state').fetchall()
+        return {key: json.loads(value) for key, value in rows} or None
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def get_storage(backend: str, file_path: str, file_name: str) -> BaseStorage:
+    """Создает хранилище состояния по имени: json, memory или sqlite"""
+    if backend == 'memory':
+        return MemoryJsonStorage(
+            file_path=file_path, file_name=file_name,
+            flush_interval=etl_settings.STATE_FLUSH_INTERVAL)
+    if backend == 'sqlite':
+        return SQLiteStorage(
+            file_path=file_path,
+            file_name=etl_settings.STATE_SQLITE_FILE_NAME,
+            legacy_file_name=file_name)
+    return JsonFileStorage(file_path=file_path, file_name=file_name)
+
+
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не
@@ -61,6 +221,9 @@ class State:
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
         self.storage.save_state(state={key: value})
+        if self.state is None:
+            self.state = {}
+        self.state[key] = copy.deepcopy(value)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
@@ -0,0 +1,87 @@
+from typing import Any, Iterable, Iterator, Optional
+
+__all__ = ['FilmworkDocument', 'transform_filmworks']
+
+
+class FilmworkDocument:
+    """
+    Накопитель документа фильма для Elasticsearch.
+    Дедупликация выполняется словарями, поэтому каждая строка обрабатывается
+    за O(1) с сохранением порядка добавления
+    """
+    __slots__ = ('id', 'imdb_rating', 'title', 'description', 'genres',
+                 'directors', 'actors', 'writers', 'checksum')
+
+    def __init__(self, filmwork_id: str, row: dict):
+        self.id = filmwork_id
+        self.imdb_rating = row.get('rating')
+        self.title = row.get('title')
+        self.description = row.get('description')
+        self.checksum = row.get('checksum')
+        self.genres: dict[str, None] = {}
+        self.directors: dict[str, None] = {}
+        self.actors: dict[tuple, None] = {}
+        self.writers: dict[tuple, None] = {}
+
+    def add(self, row: dict) -> None:
+        """Добавляет в документ жанр и персонажа из строки выборки"""
+        if (genre := row.get('genre')) is not None:
+            self.genres[genre] = None
+
+        role = row.get('role')
+        if role == 'director':
+            self.directors[row.get('full_name')] = None
+        elif role == 'actor':
+            self.actors[(row.get('person_id'), row.get('full_name'))] = None
+        elif role == 'writer':
+            self.writers[(row.get('person_id'), row.get('full_name'))] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        """Возвращает документ в формате индекса movies"""
+        return {
+            'id': self.id,
+            'imdb_rating': self.imdb_rating,
+            'title': self.title,
+            'description': self.description,
+            'genre': list(self.genres),
+            'director': list(self.directors),
+            'actors_names': list(dict.fromkeys(
+                name for _, name in self.actors)),
+            'writers_names': list(dict.fromkeys(
+                name for _, name in self.writers)),
+            'actors': [{'id': person_id, 'name': name}
+                       for person_id, name in self.actors],
+            'writers': [{'id': person_id, 'name': name}
+                        for person_id, name in self.writers],
+            'checksum': self.checksum,
+        }
+
+
+def transform_filmworks(rows: Optional[Iterable[dict]],
+                        ordered: bool = True) -> Iterator[dict[str, Any]]:
+    """
+    Группирует строки выборки фильмов в документы за один проход.
+
+    Если строки отсортированы по ID фильма (ordered=True), документ
+    отдается сразу, как только начинаются строки следующего фильма.
+    Иначе документы накапливаются и отдаются после обработки всех строк
+    """
+    if rows is None:
+        return
+
+    documents: dict[str, FilmworkDocument] = {}
+    current: Optional[FilmworkDocument] = None
+    for row in rows:
+        filmwork_id = row.get('fw_id')
+        if current is None or current.id != filmwork_id:
+            if ordered and current is not None:
+                yield current.to_dict()
+                del documents[current.id]
+            current = documents.get(filmwork_id)
+            if current is None:
+                current = FilmworkDocument(filmwork_id=filmwork_id, row=row)
+                documents[filmwork_id] = current
+        current.add(row)
+
+    for document in documents.values():
+        yield document.to_dict()
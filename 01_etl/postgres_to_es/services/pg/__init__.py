@@ -1,3 +1,4 @@
+from .cache import *
 from .service import *
 from .models import *
 from .queries import *
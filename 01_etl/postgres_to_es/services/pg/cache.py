@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Iterable
+
+from services.etl.metrics import DIMENSION_CACHE
+
+__all__ = ['DimensionCache']
+
+
+class DimensionCache:
+    """
+    LRU-кеш справочника ID -> имя (персонажи, жанры) с ограниченным
+    временем жизни записей. Общий для всех потоков процесса. Записи
+    обновляются по изменениям справочника, а ttl ограничивает срок,
+    в течение которого может отдаваться пропущенное изменение
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, ids: Iterable[str]) -> dict[str, str]:
+        """Возвращает имена из кеша, устаревшие записи удаляются"""
+        now = monotonic()
+        found: dict[str, str] = {}
+        missed = 0
+        with self.lock:
+            for entry_id in ids:
+                entry = self.entries.get(entry_id)
+                if entry is None or entry[0] < now:
+                    if entry is not None:
+                        del self.entries[entry_id]
+                    missed += 1
+                    continue
+                self.entries.move_to_end(entry_id)
+                found[entry_id] = entry[1]
+        DIMENSION_CACHE.labels(self.name, 'hit').inc(len(found))
+        DIMENSION_CACHE.labels(self.name, 'miss').inc(missed)
+        return found
+
+    def put_many(self, values: dict[str, str]) -> None:
+        """Добавляет или обновляет записи, вытесняя самые старые"""
+        expires = monotonic() + self.ttl
+        with self.lock:
+            for entry_id, value in values.items():
+                self.entries[entry_id] = (expires, value)
+                self.entries.move_to_end(entry_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
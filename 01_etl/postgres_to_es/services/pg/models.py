@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Type
 
 from pydantic import BaseModel
 
@@ -22,10 +22,12 @@ class FilmworkModel(PGBaseModel):
 
 class GenreModel(PGBaseModel):
     """Модель жанров"""
+    name: Optional[str] = None
 
 
 class PersonModel(PGBaseModel):
     """Модель персонажей"""
+    full_name: Optional[str] = None
 
 
 class GenreFilmworkModel(PGBaseModel):
@@ -52,3 +54,56 @@ class ESFilmworkModel(UUIDMixin):
     writers_names: Optional[List[str]] = None
     actors: Optional[List[ESPersonModel]] = None
     writers: Optional[List[ESPersonModel]] = None
+    checksum: Optional[int] = None
+
+
+class ESGenreDocumentModel(UUIDMixin):
+    """Модель документов индекса жанров"""
+    name: str
+    description: Optional[str] = None
+
+
+class ESPersonDocumentModel(UUIDMixin):
+    """Модель документов индекса персонажей"""
+    full_name: str
+    roles: List[str] = []
+    film_ids: List[str] = []
+
+
+ES_FILMWORK_FIELDS = frozenset(ESFilmworkModel.__fields__)
+ES_FILMWORK_REQUIRED = tuple(
+    name for name, field in ESFilmworkModel.__fields__.items()
+    if field.required)
+
+
+def is_valid_filmwork(document: dict) -> bool:
+    """
+    Быстрая проверка документа фильма без создания модели: набор полей
+    совпадает со схемой, обязательные поля заполнены строками,
+    рейтинг уже приведен к float
+    """
+    return (document.keys() == ES_FILMWORK_FIELDS
+            and all(isinstance(document[name], str)
+                    for name in ES_FILMWORK_REQUIRED)
+            and isinstance(document['imdb_rating'], (float, type(None))))
+
+
+def validate_filmworks(documents: Iterable[dict],
+                       batch_size: int = 500) -> Iterator[dict]:
+    """
+    Проверяет документы фильмов по схеме ESFilmworkModel.
+    Полная проверка pydantic выполняется для первого документа каждого
+    пакета из batch_size документов и для документов, не прошедших
+    быструю проверку. Остальные документы отдаются без копирования
+    """
+    for position, document in enumerate(documents):
+        if position % batch_size == 0 or not is_valid_filmwork(document):
+            document = ESFilmworkModel(**document).dict()
+        yield document
+
+
+def validate_documents(documents: Iterable[dict],
+                       model: Type[BaseModel]) -> Iterator[dict]:
+    """Проверяет документы дополнительного индекса по схеме model"""
+    for document in documents:
+        yield model(**document).dict()
@@ -1,71 +1,142 @@
+from typing import NamedTuple
+from uuid import UUID
+
 from config.settings import etl_settings
 
+MIN_ID = '00000000-0000-0000-0000-000000000000'
 
-def modified_filmworks(timestamp) -> str:
-    """Запрос получения обновленных фильмов за промежуток времени"""
-    return f"""
-        SELECT id, modified
-        FROM content.film_work
-        WHERE modified > '{timestamp}'
-        ORDER BY modified
-        LIMIT {etl_settings.LIMIT};
-    """
+"""Роли, которые хранятся в документе фильма без ID персонажа"""
+UNLINKED_ROLES = ('director',)
 
 
-def modified_person(timestamp) -> str:
-    """Запрос получения обновленных персонажей за промежуток времени"""
-    return f"""
-        SELECT id, modified
-        FROM content.person
-        WHERE modified > '{timestamp}'
-        ORDER BY modified
-        LIMIT {etl_settings.LIMIT};
+class Query(NamedTuple):
+    """
+    Параметризованный запрос. Выполняется как подготовленный оператор
+    name с параметрами $1..$n типов types, поэтому PostgreSQL разбирает
+    и планирует его один раз на соединение, а текст не зависит от
+    количества переданных ID
     """
+    name: str
+    text: str
+    types: tuple = ()
+    params: tuple = ()
 
+    def bind(self, *params) -> 'Query':
+        """Возвращает запрос с привязанными значениями параметров"""
+        return self._replace(params=params)
 
-def filmwork_by_person(persons: list) -> str:
+
+def modified_rows_query(name: str, table: str,
+                        columns: str = 'id, modified') -> Query:
     """
-    Запрос получения фильмов, в которых приняли
-    участие обновленные персонажи
+    Запрос получения страницы обновленных записей таблицы.
+    Постраничный обход по ключу (modified, id) не пропускает записи
+    с одинаковым modified на границе страниц
     """
-    condition = f"IN {tuple(persons)}" if len(
-        persons) > 1 else f"= '{persons[0]}'"
-    return f"""
-        SELECT fw.id, fw.modified
+    return Query(
+        name=name,
+        text=f"""
+            SELECT {columns}
+            FROM {table}
+            WHERE (modified, id) > ($1, $2)
+            ORDER BY modified, id
+            LIMIT $3
+        """,
+        types=('timestamptz', 'uuid', 'integer'),
+    )
+
+
+MODIFIED_FILMWORKS = modified_rows_query(name='etl_modified_filmworks',
+                                         table='content.film_work')
+MODIFIED_PERSON = modified_rows_query(name='etl_modified_person',
+                                      table='content.person',
+                                      columns='id, modified, full_name')
+MODIFIED_GENRE = modified_rows_query(name='etl_modified_genre',
+                                     table='content.genre',
+                                     columns='id, modified, name')
+
+FILMWORK_BY_PERSON = Query(
+    name='etl_filmwork_by_person',
+    text="""
+        SELECT DISTINCT fw.id, fw.modified
         FROM content.film_work fw
-        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-        WHERE pfw.person_id {condition}
-        ORDER BY fw.modified;
-    """
+        JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        WHERE fw.id > $2 AND (
+            pfw.person_id = ANY($1)
+            OR pfw.person_id = ANY($4) AND pfw.role = ANY($5))
+        ORDER BY fw.id
+        LIMIT $3
+    """,
+    types=('uuid[]', 'uuid', 'integer', 'uuid[]', 'text[]'),
+)
 
+FILMWORK_BY_GENRE = Query(
+    name='etl_filmwork_by_genre',
+    text="""
+        SELECT DISTINCT fw.id, fw.modified
+        FROM content.film_work fw
+        JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        WHERE gfw.genre_id = ANY($1) AND fw.id > $2
+        ORDER BY fw.id
+        LIMIT $3
+    """,
+    types=('uuid[]', 'uuid', 'integer'),
+)
 
-def modified_genre(timestamp) -> str:
-    """Запрос получения обновленных жанров за промежуток времени"""
-    return f"""
-        SELECT id, modified
-        FROM content.genre
-        WHERE modified > '{timestamp}'
-        ORDER BY modified
-        LIMIT {etl_settings.LIMIT};
+
+def modified_filmworks(modified, last_id: str = MIN_ID) -> Query:
+    """Запрос получения обновленных фильмов после позиции курсора"""
+    return MODIFIED_FILMWORKS.bind(modified, last_id, etl_settings.LIMIT)
+
+
+def modified_person(modified, last_id: str = MIN_ID) -> Query:
+    """Запрос получения обновленных персонажей после позиции курсора"""
+    return MODIFIED_PERSON.bind(modified, last_id, etl_settings.LIMIT)
+
+
+def filmwork_by_person(persons: list, after: str = MIN_ID,
+                       renamed: list = ()) -> Query:
+    """
+    Запрос получения очередной порции фильмов, в которых приняли
+    участие обновленные персонажи persons, а переименованные персонажи
+    renamed - в ролях без ID в документе, начиная с фильма после after
     """
+    return FILMWORK_BY_PERSON.bind(list(persons), after,
+                                   etl_settings.FANOUT_LIMIT, list(renamed),
+                                   list(UNLINKED_ROLES))
 
 
-def filmwork_by_genre(genres: list) -> str:
-    """Запрос получения фильмов по обновленным жанрам"""
-    condition = f"IN {tuple(genres)}" if len(
-        genres) > 1 else f"= '{genres[0]}'"
-    return f"""
-        SELECT fw.id, fw.modified
-        FROM content.film_work fw
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        WHERE gfw.genre_id {condition}
-        ORDER BY fw.modified;
+def modified_genre(modified, last_id: str = MIN_ID) -> Query:
+    """Запрос получения обновленных жанров после позиции курсора"""
+    return MODIFIED_GENRE.bind(modified, last_id, etl_settings.LIMIT)
+
+
+def filmwork_by_genre(genres: list, after: str = MIN_ID) -> Query:
+    """
+    Запрос получения очередной порции фильмов по обновленным жанрам,
+    начиная с фильма после after
     """
+    return FILMWORK_BY_GENRE.bind(list(genres), after,
+                                  etl_settings.FANOUT_LIMIT)
 
 
-def filmwork_by_id(ids: tuple) -> str:
-    """Запрос получения всей информации экземпляров фильмов"""
-    condition = f"IN {tuple(ids)}" if len(ids) > 1 else f"= '{ids[0]}'"
+"""
+Контрольная сумма фильма для сверки с Elasticsearch: 28 бит md5 от
+полей фильма, которые попадают в документ. Время изменения в сумму
+не входит, поэтому фильм, у которого изменилось только modified,
+сохраняет хеш документа и не отправляется повторно. Сумма по диапазону
+до 2^25 фильмов точно представима в double, в котором Elasticsearch
+считает агрегацию sum
+"""
+CHECKSUM = ("('x' || substr(md5(row(fw.id, fw.title, fw.description, "
+            "fw.rating)::text), 1, 7))::bit(28)::integer")
+
+
+def filmwork_rows(where: str = '') -> str:
+    """
+    Запрос получения всей информации экземпляров фильмов,
+    отсортированной по ID фильма
+    """
     return f"""
         SELECT
             fw.id as fw_id,
@@ -75,6 +146,7 @@ def filmwork_by_id(ids: tuple) -> str:
             fw.type,
             fw.created,
             fw.modified,
+            {CHECKSUM} as checksum,
             pfw.role,
             p.id as person_id,
             p.full_name,
@@ -84,5 +156,415 @@ def filmwork_by_id(ids: tuple) -> str:
         LEFT JOIN content.person p ON p.id = pfw.person_id
         LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
         LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.id {condition};
+        {where}
+        ORDER BY fw.id
+    """
+
+
+FILMWORK_BY_ID = Query(
+    name='etl_filmwork_by_id',
+    text=filmwork_rows(where='WHERE fw.id = ANY($1)'),
+    types=('uuid[]',),
+)
+
+
+def filmwork_by_id(ids: tuple) -> Query:
+    """Запрос получения всей информации экземпляров фильмов"""
+    return FILMWORK_BY_ID.bind(list(ids))
+
+
+FILMWORK_LINKS_BY_ID = Query(
+    name='etl_filmwork_links_by_id',
+    text=f"""
+        SELECT
+            fw.id as fw_id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            {CHECKSUM} as checksum,
+            COALESCE(p.person_ids, '{{}}') as person_ids,
+            COALESCE(p.roles, '{{}}') as roles,
+            COALESCE(g.genre_ids, '{{}}') as genre_ids
+        FROM content.film_work fw
+        LEFT JOIN LATERAL (
+            SELECT
+                array_agg(pfw.person_id::text) as person_ids,
+                array_agg(pfw.role::text) as roles
+            FROM content.person_film_work pfw
+            WHERE pfw.film_work_id = fw.id
+        ) p ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT array_agg(gfw.genre_id::text) as genre_ids
+            FROM content.genre_film_work gfw
+            WHERE gfw.film_work_id = fw.id
+        ) g ON TRUE
+        WHERE fw.id = ANY($1)
+        ORDER BY fw.id
+    """,
+    types=('uuid[]',),
+)
+
+PERSONS_BY_ID = Query(
+    name='etl_persons_by_id',
+    text="""
+        SELECT id, full_name
+        FROM content.person
+        WHERE id = ANY($1)
+    """,
+    types=('uuid[]',),
+)
+
+GENRES_BY_ID = Query(
+    name='etl_genres_by_id',
+    text="""
+        SELECT id, name
+        FROM content.genre
+        WHERE id = ANY($1)
+    """,
+    types=('uuid[]',),
+)
+
+
+def filmwork_links_by_id(ids: tuple) -> Query:
+    """
+    Запрос получения фильмов с ID связанных персонажей (и их ролями)
+    и жанров: одна узкая строка на фильм без соединения со справочниками
+    """
+    return FILMWORK_LINKS_BY_ID.bind(list(ids))
+
+
+def all_filmworks() -> str:
+    """Запрос получения всей информации всех фильмов каталога"""
+    return filmwork_rows()
+
+
+def filmwork_documents(where: str = '') -> str:
+    """
+    Запрос получения готовых документов фильмов: одна строка на фильм,
+    жанры и персонажи агрегируются на стороне PostgreSQL
+    """
+    return f"""
+        SELECT
+            fw.id,
+            fw.rating as imdb_rating,
+            fw.title,
+            fw.description,
+            {CHECKSUM} as checksum,
+            COALESCE(g.genre, '{{}}') as genre,
+            COALESCE(p.director, '{{}}') as director,
+            COALESCE(p.actors_names, '{{}}') as actors_names,
+            COALESCE(p.writers_names, '{{}}') as writers_names,
+            COALESCE(p.actors, '[]') as actors,
+            COALESCE(p.writers, '[]') as writers
+        FROM content.film_work fw
+        LEFT JOIN LATERAL (
+            SELECT array_agg(DISTINCT g.name) as genre
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+        ) g ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT
+                array_agg(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'director') as director,
+                array_agg(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'actor') as actors_names,
+                array_agg(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'writer') as writers_names,
+                jsonb_agg(DISTINCT jsonb_build_object(
+                    'id', p.id, 'name', p.full_name))
+                    FILTER (WHERE pfw.role = 'actor') as actors,
+                jsonb_agg(DISTINCT jsonb_build_object(
+                    'id', p.id, 'name', p.full_name))
+                    FILTER (WHERE pfw.role = 'writer') as writers
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ) p ON TRUE
+        {where}
+        ORDER BY fw.id
+    """
+
+
+FILMWORK_DOCUMENTS_BY_ID = Query(
+    name='etl_filmwork_documents_by_id',
+    text=filmwork_documents(where='WHERE fw.id = ANY($1)'),
+    types=('uuid[]',),
+)
+
+
+def filmwork_documents_by_id(ids: tuple) -> Query:
+    """Запрос получения готовых документов фильмов по ID"""
+    return FILMWORK_DOCUMENTS_BY_ID.bind(list(ids))
+
+
+def all_filmwork_documents() -> str:
+    """Запрос получения готовых документов всех фильмов каталога"""
+    return filmwork_documents()
+
+
+def genre_documents(where: str = '') -> str:
+    """Запрос получения документов индекса жанров"""
+    return f"""
+        SELECT g.id, g.name, g.description
+        FROM content.genre g
+        {where}
+        ORDER BY g.id
+    """
+
+
+GENRE_DOCUMENTS_BY_ID = Query(
+    name='etl_genre_documents_by_id',
+    text=genre_documents(where='WHERE g.id = ANY($1)'),
+    types=('uuid[]',),
+)
+
+
+def person_documents(where: str = '') -> str:
+    """
+    Запрос получения документов индекса персонажей: роли и ID фильмов
+    персонажа агрегируются на стороне PostgreSQL
+    """
+    return f"""
+        SELECT
+            p.id,
+            p.full_name,
+            COALESCE(pfw.roles, '{{}}') as roles,
+            COALESCE(pfw.film_ids, '{{}}') as film_ids
+        FROM content.person p
+        LEFT JOIN LATERAL (
+            SELECT
+                array_agg(DISTINCT pfw.role::text) as roles,
+                array_agg(DISTINCT pfw.film_work_id::text) as film_ids
+            FROM content.person_film_work pfw
+            WHERE pfw.person_id = p.id
+        ) pfw ON TRUE
+        {where}
+        ORDER BY p.id
     """
+
+
+PERSON_DOCUMENTS_BY_ID = Query(
+    name='etl_person_documents_by_id',
+    text=person_documents(where='WHERE p.id = ANY($1)'),
+    types=('uuid[]',),
+)
+
+"""ID жанров и персонажей, которые еще есть в PostgreSQL"""
+EXISTING_GENRES = Query(
+    name='etl_existing_genres',
+    text="""
+        SELECT id::text as id
+        FROM content.genre
+        WHERE id = ANY($1)
+    """,
+    types=('uuid[]',),
+)
+
+EXISTING_PERSONS = Query(
+    name='etl_existing_persons',
+    text="""
+        SELECT id::text as id
+        FROM content.person
+        WHERE id = ANY($1)
+    """,
+    types=('uuid[]',),
+)
+
+PERSONS_BY_FILMWORK = Query(
+    name='etl_persons_by_filmwork',
+    text="""
+        SELECT DISTINCT person_id as id
+        FROM content.person_film_work
+        WHERE film_work_id = ANY($1)
+    """,
+    types=('uuid[]',),
+)
+
+"""Текущие имена персонажей и названия жанров для хранилища имен"""
+NAMES = {
+    'person': 'SELECT id::text AS id, full_name AS name FROM content.person;',
+    'genre': 'SELECT id::text AS id, name FROM content.genre;',
+}
+
+
+"""Сверка с Elasticsearch по диапазонам ID фильмов"""
+RANGE_CHECKSUMS = Query(
+    name='etl_range_checksums',
+    text=f"""
+        SELECT
+            left(fw.id::text, $3) as prefix,
+            count(*) as count,
+            sum({CHECKSUM}) as checksum
+        FROM unnest($1, $2) AS r(low, high)
+        JOIN content.film_work fw ON fw.id BETWEEN r.low AND r.high
+        GROUP BY 1
+    """,
+    types=('uuid[]', 'uuid[]', 'integer'),
+)
+
+RANGE_DOCUMENTS = Query(
+    name='etl_range_documents',
+    text=f"""
+        SELECT fw.id, {CHECKSUM} as checksum
+        FROM content.film_work fw
+        WHERE fw.id BETWEEN $1 AND $2
+    """,
+    types=('uuid', 'uuid'),
+)
+
+
+def prefix_bounds(prefix: str) -> tuple[str, str]:
+    """Первый и последний UUID, текст которых начинается с prefix"""
+    digits = prefix.replace('-', '')
+    return (str(UUID(hex=digits.ljust(32, '0'))),
+            str(UUID(hex=digits.ljust(32, 'f'))))
+
+
+def range_checksums(prefixes: list[str], length: int) -> Query:
+    """
+    Запрос количества фильмов и суммы их контрольных сумм по
+    поддиапазонам с префиксом ID длины length внутри диапазонов prefixes.
+    Диапазоны ID читаются по первичному ключу
+    """
+    bounds = [prefix_bounds(prefix) for prefix in prefixes]
+    return RANGE_CHECKSUMS.bind([low for low, _ in bounds],
+                                [high for _, high in bounds], length)
+
+
+def range_documents(prefix: str) -> Query:
+    """Запрос ID и контрольных сумм фильмов диапазона prefix"""
+    return RANGE_DOCUMENTS.bind(*prefix_bounds(prefix))
+
+
+"""Общее состояние и аренды шардов для нескольких процессов ETL"""
+SHARED_STATE_SCHEMA = """
+    CREATE SCHEMA IF NOT EXISTS etl;
+    CREATE TABLE IF NOT EXISTS etl.lease (
+        shard integer PRIMARY KEY,
+        owner text NOT NULL,
+        expires_at timestamptz NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS etl.state (
+        name text PRIMARY KEY,
+        value jsonb NOT NULL DEFAULT '{}'
+    );
+"""
+
+ACQUIRE_LEASE = Query(
+    name='etl_acquire_lease',
+    text="""
+        INSERT INTO etl.lease AS lease (shard, owner, expires_at)
+        VALUES ($1, $2, now() + make_interval(secs => $3))
+        ON CONFLICT (shard) DO UPDATE
+            SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+            WHERE lease.owner = EXCLUDED.owner OR lease.expires_at < now()
+        RETURNING shard
+    """,
+    types=('integer', 'text', 'double precision'),
+)
+
+RELEASE_LEASES = Query(
+    name='etl_release_leases',
+    text="""
+        UPDATE etl.lease SET expires_at = now()
+        WHERE shard = ANY($1) AND owner = $2
+        RETURNING shard
+    """,
+    types=('integer[]', 'text'),
+)
+
+LIVE_LEASES = Query(
+    name='etl_live_leases',
+    text="""
+        SELECT shard, owner
+        FROM etl.lease
+        WHERE expires_at >= now()
+    """,
+)
+
+SAVE_SHARED_STATE = Query(
+    name='etl_save_shared_state',
+    text="""
+        INSERT INTO etl.state AS state (name, value)
+        VALUES ($1, $2)
+        ON CONFLICT (name) DO UPDATE SET value = state.value || EXCLUDED.value
+    """,
+    types=('text', 'jsonb'),
+)
+
+"""
+Сохранение состояния шарда только владельцем действующей аренды:
+процесс, чья аренда истекла, не перезапишет курсор нового владельца
+"""
+SAVE_FENCED_STATE = Query(
+    name='etl_save_fenced_state',
+    text="""
+        INSERT INTO etl.state AS state (name, value)
+        SELECT $1, $2
+        FROM etl.lease
+        WHERE shard = $3 AND owner = $4 AND expires_at >= now()
+        ON CONFLICT (name) DO UPDATE SET value = state.value || EXCLUDED.value
+        RETURNING name
+    """,
+    types=('text', 'jsonb', 'integer', 'text'),
+)
+
+LOAD_SHARED_STATE = Query(
+    name='etl_load_shared_state',
+    text="""
+        SELECT value
+        FROM etl.state
+        WHERE name = $1
+    """,
+    types=('text',),
+)
+
+
+"""Уведомления об изменениях каталога для событийного режима ETL"""
+NOTIFY_TABLES = ('film_work', 'person', 'genre', 'person_film_work',
+                 'genre_film_work')
+
+NOTIFY_FUNCTION = """
+    CREATE SCHEMA IF NOT EXISTS etl;
+    CREATE OR REPLACE FUNCTION etl.notify_change() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify(TG_ARGV[0], TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+
+def notify_triggers(channel: str) -> str:
+    """
+    Триггеры на уровне оператора: одно уведомление на оператор, а не на
+    каждую строку, одинаковые уведомления транзакции PostgreSQL
+    объединяет сам
+    """
+    return NOTIFY_FUNCTION + ''.join(f"""
+    DROP TRIGGER IF EXISTS etl_notify ON content.{table};
+    CREATE TRIGGER etl_notify
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.{table}
+        FOR EACH STATEMENT EXECUTE FUNCTION etl.notify_change('{channel}');
+    """ for table in NOTIFY_TABLES)
+
+
+NOTIFY_TRIGGERS = Query(
+    name='etl_notify_triggers',
+    text="""
+        SELECT c.relname AS table_name
+        FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE t.tgname = 'etl_notify' AND n.nspname = 'content'
+            AND c.relname = ANY($1)
+    """,
+    types=('text[]',),
+)
+
+
+def notify_trigger_tables() -> Query:
+    """Запрос таблиц каталога, на которых есть триггер уведомлений"""
+    return NOTIFY_TRIGGERS.bind(list(NOTIFY_TABLES))
@@ -1,91 +1,373 @@
 import logging
-from typing import List, Optional
+import select
+from time import monotonic, perf_counter
+from typing import Iterator, List, Optional, Union
 
 import psycopg2
 from config.settings import etl_settings, pg_settings
-from psycopg2 import OperationalError
+from psycopg2 import InterfaceError, OperationalError
 from psycopg2.extensions import connection as _connection
 from psycopg2.extras import DictCursor
-from services.etl import backoff
+from psycopg2.pool import ThreadedConnectionPool
+from services.etl import CircuitBreaker, backoff
+from services.etl.metrics import PG_QUERY_SECONDS, PG_ROWS
 from services.pg import models, queries
+from services.pg.cache import DimensionCache
 
 logger = logging.getLogger(__name__)
 
+pg_breaker = CircuitBreaker(
+    name='postgres',
+    failure_threshold=etl_settings.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=etl_settings.BREAKER_RESET_TIMEOUT)
+
+"""Справочники персонажей и жанров, общие для всех соединений процесса"""
+person_cache = DimensionCache(name='person',
+                              maxsize=etl_settings.DIMENSION_CACHE_SIZE,
+                              ttl=etl_settings.DIMENSION_CACHE_TTL)
+genre_cache = DimensionCache(name='genre',
+                             maxsize=etl_settings.DIMENSION_CACHE_SIZE,
+                             ttl=etl_settings.DIMENSION_CACHE_TTL)
+
 
 class PostgresService:
-    def __init__(self):
+    def __init__(self, pool: Optional[ThreadedConnectionPool] = None):
         self.state_field = etl_settings.STATE_FIELD
+        self.pool = pool
+        self.prepared: set[str] = set()
         self.conn = self.__connect()
 
     @backoff(exception=OperationalError)
     def __connect(self):
         logger.info('Connecting to PostgreSQL ...')
+        if self.pool is not None:
+            conn = self.pool.getconn()
+            logger.info('Connection taken from PostgreSQL pool')
+            return conn
         with PostgresConnector().connection as conn:
             logger.info('Connected to PostgreSQL completed')
             return conn
 
     def close(self):
         if self.conn:
-            self.conn.close()
-            logger.info('PostgreSQL connection closed')
+            if self.pool is not None:
+                self.pool.putconn(self.conn, close=bool(self.conn.closed))
+                logger.info('PostgreSQL connection returned to pool')
+            else:
+                self.conn.close()
+                logger.info('PostgreSQL connection closed')
+            self.conn = None
+
+    def is_alive(self) -> bool:
+        """Проверяет, что соединение с PostgreSQL рабочее"""
+        try:
+            self.executor(query='SELECT 1;')
+        except (OperationalError, InterfaceError):
+            return False
+        return True
+
+    def reconnect(self):
+        """Заменяет сломанное соединение новым"""
+        if self.conn:
+            self.prepared.clear()
+            if self.pool is not None:
+                self.pool.putconn(self.conn, close=True)
+            else:
+                self.conn.close()
+        with pg_breaker.guard((OperationalError, InterfaceError)):
+            self.conn = self.__connect()
+
+    def executor(self, query: Union[str, queries.Query],
+                 fetch: bool = True):
+        """
+        Возвращает результат запроса к PostgreSQL (при fetch=False запрос
+        только выполняется). Параметризованные запросы выполняются как
+        подготовленные операторы. Транзакция завершается сразу после
+        чтения, чтобы долгоживущее соединение не простаивало внутри
+        открытой транзакции. При разомкнутой цепи запрос не выполняется
+        (CircuitOpenError)
+        """
+        name = query.name if isinstance(query, queries.Query) else 'raw'
+        started = perf_counter()
+        with pg_breaker.guard((OperationalError, InterfaceError)):
+            with self.conn:
+                with self.conn.cursor() as curs:
+                    if isinstance(query, queries.Query):
+                        self.prepare(curs=curs, query=query)
+                        placeholders = ', '.join(
+                            f'%s::{param_type}'
+                            for param_type in query.types)
+                        arguments = (f' ({placeholders})' if query.types
+                                     else '')
+                        curs.execute(f'EXECUTE {query.name}{arguments};',
+                                     query.params)
+                    else:
+                        curs.execute(query)
+                    rows = curs.fetchall() if fetch else None
+        PG_QUERY_SECONDS.labels(name).observe(perf_counter() - started)
+        if rows:
+            PG_ROWS.labels(name).inc(len(rows))
+        return rows
 
-    def executor(self, query):
-        """Возвращает результат запроса к PostgreSQL"""
+    def prepare(self, curs, query: queries.Query) -> None:
+        """
+        Готовит оператор на сервере один раз для соединения. Соединения
+        из пула сохраняют подготовленные операторы между циклами
+        """
+        if query.name in self.prepared:
+            return
+        curs.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s;',
+                     (query.name,))
+        if curs.fetchone() is None:
+            types = f' ({", ".join(query.types)})' if query.types else ''
+            curs.execute(f'PREPARE {query.name}{types} AS {query.text};')
+            logger.info("Statement '%s' prepared", query.name)
+        self.prepared.add(query.name)
+
+    def install_notify_triggers(self, channel: str) -> None:
+        """Создает триггеры уведомлений об изменениях таблиц каталога"""
+        self.executor(query=queries.notify_triggers(channel=channel),
+                      fetch=False)
+        logger.info("Notify triggers installed for channel '%s'", channel)
+
+    def get_missing_notify_triggers(self) -> list[str]:
+        """Таблицы каталога без триггера уведомлений об изменениях"""
+        installed = {row['table_name'] for row in self.executor(
+            query=queries.notify_trigger_tables())}
+        return [table for table in queries.NOTIFY_TABLES
+                if table not in installed]
+
+    def listen(self, channel: str) -> None:
+        """
+        Подписывает соединение на канал уведомлений. Соединение
+        переводится в autocommit, поэтому должно быть отдельным
+        """
+        self.conn.autocommit = True
         with self.conn.cursor() as curs:
-            curs.execute(query)
-            return curs.fetchall()
+            curs.execute(f'LISTEN {channel};')
+        logger.info("Listening to channel '%s'", channel)
+
+    def wait_notifications(self, timeout: float, debounce: float,
+                           max_delay: float) -> set[str]:
+        """
+        Ждет уведомления не дольше timeout. После первого уведомления
+        продолжает собирать пачку, пока уведомления приходят чаще
+        debounce, но не дольше max_delay. Возвращает имена измененных
+        таблиц (пустое множество, если уведомлений не было)
+        """
+        tables: set[str] = set()
+        deadline = monotonic() + timeout
+        burst = None
+        while True:
+            self.conn.poll()
+            while self.conn.notifies:
+                tables.add(self.conn.notifies.pop(0).payload)
+            if tables:
+                burst = burst or monotonic()
+                wait = min(debounce, burst + max_delay - monotonic())
+            else:
+                wait = deadline - monotonic()
+            if wait <= 0:
+                break
+            if not select.select([self.conn], [], [], wait)[0]:
+                break
+        return tables
+
+    def stream(self, query, name: str = 'etl_stream',
+               itersize: Optional[int] = None) -> Iterator:
+        """
+        Построчно возвращает результат запроса через именованный
+        (серверный) курсор. В памяти находится не более itersize строк
+        """
+        with self.conn:
+            with self.conn.cursor(name=name) as curs:
+                curs.itersize = itersize or etl_settings.FETCH_SIZE
+                curs.execute(query)
+                rows = PG_ROWS.labels(name)
+                for row in curs:
+                    rows.inc()
+                    yield row
+
+    def get_snapshot_time(self) -> str:
+        """
+        Возвращает текущее время PostgreSQL. Все изменения, зафиксированные
+        до этого момента, будут видны следующим запросам
+        """
+        return f"{self.executor(query='SELECT now() as now;')[0]['now']}"
 
-    def get_modified_person(self, timestamp) -> list:
+    def get_modified_person(self, modified,
+                            last_id: str = queries.MIN_ID) -> list:
         """Возвращает список новых/измененных персонажей"""
         persons = self.executor(
-            query=queries.modified_person(timestamp=timestamp)
+            query=queries.modified_person(modified=modified, last_id=last_id)
         )
         if persons:
-            return [models.PersonModel(**person) for person in persons]
+            persons = [models.PersonModel(**person) for person in persons]
+            person_cache.put_many(
+                {person.id: person.full_name for person in persons})
+            return persons
         return []
 
-    def get_filmwork_by_person(self, persons: List[str]) -> List[str]:
-        """Возвращает список фильмов, в которых участвуют персонажи"""
+    def get_filmwork_by_person(self, persons: List[str],
+                               after: str = queries.MIN_ID,
+                               renamed: List[str] = ()) -> List[str]:
+        """
+        Возвращает очередную порцию ID фильмов, в которых участвуют
+        персонажи persons, а переименованные персонажи renamed - в ролях
+        без ID в документе (режиссеры), отсортированных по ID
+        """
         filmworks = self.executor(
-            query=queries.filmwork_by_person(persons=persons)
+            query=queries.filmwork_by_person(persons=persons, after=after,
+                                             renamed=renamed)
         )
         return [
             models.PersonFilmworkModel(**filmwork).id for filmwork in filmworks
         ]
 
-    def get_modified_genre(self, timestamp) -> list:
+    def get_modified_genre(self, modified,
+                           last_id: str = queries.MIN_ID) -> list:
         """Возвращает список новых/измененных жанров"""
         genres = self.executor(
-            query=queries.modified_genre(timestamp=timestamp)
+            query=queries.modified_genre(modified=modified, last_id=last_id)
         )
         if genres:
-            return [models.GenreModel(**genre) for genre in genres]
+            genres = [models.GenreModel(**genre) for genre in genres]
+            genre_cache.put_many({genre.id: genre.name for genre in genres})
+            return genres
         return []
 
-    def get_filmwork_by_genre(self, genres: List[str]) -> List[str]:
-        """Возвращает список фильмов по жанрам"""
+    def get_filmwork_by_genre(self, genres: List[str],
+                              after: str = queries.MIN_ID) -> List[str]:
+        """
+        Возвращает очередную порцию ID фильмов по жанрам,
+        отсортированных по ID
+        """
         filmworks = self.executor(
-            query=queries.filmwork_by_genre(genres=genres)
+            query=queries.filmwork_by_genre(genres=genres, after=after)
         )
         return [
             models.GenreFilmworkModel(**filmwork).id for filmwork in filmworks
         ]
 
-    def get_modified_filmwork(self, timestamp) -> list:
+    def get_modified_filmwork(self, modified,
+                              last_id: str = queries.MIN_ID) -> list:
         """Возвращает список новых/измененных фильмов"""
         filmworks = self.executor(
-            query=queries.modified_filmworks(timestamp=timestamp)
+            query=queries.modified_filmworks(modified=modified,
+                                             last_id=last_id)
         )
         if filmworks:
             return [models.FilmworkModel(**filmwork) for filmwork in filmworks]
         return []
 
     def get_filmwork_instances(self, ids: tuple) -> None:
-        """Возвращает экземпляры фильмов"""
+        """
+        Возвращает экземпляры фильмов. При включенном кеше справочников
+        строки собираются из узких связей фильмов и имен из кеша
+        """
+        if not ids:
+            return None
+        if etl_settings.DIMENSION_CACHE_ENABLED:
+            return self.get_filmwork_rows(ids=ids)
+        return self.executor(query=queries.filmwork_by_id(ids=ids))
+
+    def lookup_names(self, cache: DimensionCache, query: queries.Query,
+                     column: str, ids: set[str]) -> dict[str, str]:
+        """Имена записей справочника: из кеша, недостающие из PostgreSQL"""
+        names = cache.get_many(ids)
+        if missing := [entry_id for entry_id in ids if entry_id not in names]:
+            fetched = {row['id']: row[column]
+                       for row in self.executor(query=query.bind(missing))}
+            cache.put_many(fetched)
+            names.update(fetched)
+        return names
+
+    def get_filmwork_rows(self, ids: tuple) -> List[dict]:
+        """
+        Строки фильмов в формате filmwork_by_id: по строке на каждый
+        жанр и каждого персонажа фильма, имена берутся из кеша
+        """
+        films = self.executor(query=queries.filmwork_links_by_id(ids=ids))
+        persons = self.lookup_names(
+            cache=person_cache, query=queries.PERSONS_BY_ID,
+            column='full_name',
+            ids={person_id for film in films
+                 for person_id in film['person_ids']})
+        genres = self.lookup_names(
+            cache=genre_cache, query=queries.GENRES_BY_ID, column='name',
+            ids={genre_id for film in films for genre_id in film['genre_ids']})
+
+        rows: List[dict] = []
+        for film in films:
+            base = {'fw_id': film['fw_id'], 'title': film['title'],
+                    'description': film['description'],
+                    'rating': film['rating'], 'checksum': film['checksum']}
+            rows.append(base)
+            rows.extend({**base, 'genre': genres.get(genre_id)}
+                        for genre_id in film['genre_ids'])
+            rows.extend({**base, 'role': role, 'person_id': person_id,
+                         'full_name': persons.get(person_id)}
+                        for person_id, role in zip(film['person_ids'],
+                                                   film['roles']))
+        return rows
+
+    def get_filmwork_documents(self, ids: tuple) -> Optional[List[dict]]:
+        """
+        Возвращает готовые для индексации документы фильмов,
+        собранные агрегацией на стороне PostgreSQL
+        """
         if ids:
-            return self.executor(query=queries.filmwork_by_id(ids=ids))
+            documents = self.executor(
+                query=queries.filmwork_documents_by_id(ids=ids)
+            )
+            return [dict(document) for document in documents]
         return None
 
+    def get_documents(self, query: queries.Query,
+                      ids: List[str]) -> List[dict]:
+        """Документы дополнительного индекса по ID"""
+        rows = self.executor(query=query.bind(list(ids)))
+        return [dict(row) for row in rows or []]
+
+    def get_related_ids(self, query: queries.Query,
+                        ids: List[str]) -> List[str]:
+        """ID документов, связанных с измененными записями ids"""
+        rows = self.executor(query=query.bind(list(ids)))
+        return [row['id'] for row in rows or []]
+
+    def stream_names(self, kind: str) -> Iterator:
+        """Текущие имена всех персонажей (person) или жанров (genre)"""
+        return self.stream(query=queries.NAMES[kind],
+                           name=f'etl_{kind}_names')
+
+    def get_range_checksums(self, prefixes: List[str],
+                            length: int) -> dict[str, tuple[int, int]]:
+        """
+        Количество фильмов и сумма контрольных сумм по поддиапазонам
+        с префиксом ID длины length внутри диапазонов prefixes
+        """
+        rows = self.executor(query=queries.range_checksums(
+            prefixes=prefixes, length=length))
+        return {row['prefix']: (row['count'], row['checksum'])
+                for row in rows or []}
+
+    def get_range_documents(self, prefix: str) -> dict[str, int]:
+        """Контрольные суммы фильмов диапазона ID с префиксом prefix"""
+        rows = self.executor(query=queries.range_documents(prefix=prefix))
+        return {row['id']: row['checksum'] for row in rows or []}
+
+    def stream_filmworks(self) -> Iterator:
+        """
+        Потоково возвращает весь каталог фильмов, отсортированный по ID:
+        строки выборки или готовые документы в режиме aggregate
+        """
+        if etl_settings.EXTRACT_MODE == 'aggregate':
+            for document in self.stream(
+                    query=queries.all_filmwork_documents()):
+                yield dict(document)
+        else:
+            yield from self.stream(query=queries.all_filmworks())
+
 
 class PostgresConnector:
     def __init__(self, settings=pg_settings):
@@ -97,11 +379,18 @@ class PostgresConnector:
             'port': settings.DB_PORT,
             'options': settings.DB_OPTIONS,
         }
+        self.pool_min: int = settings.DB_POOL_MIN
+        self.pool_max: int = settings.DB_POOL_MAX
         self.conn: Optional[_connection] = None
 
     def __create_conn(self) -> _connection:
         return psycopg2.connect(**self.dsl, cursor_factory=DictCursor)
 
+    def pool(self) -> ThreadedConnectionPool:
+        """Создает пул соединений, общий для всех потоков процесса"""
+        return ThreadedConnectionPool(self.pool_min, self.pool_max,
+                                      **self.dsl, cursor_factory=DictCursor)
+
     @property
     def connection(self):
         if self.conn and not self.conn.closed: